@@ -0,0 +1,276 @@
+import sys
+import os
+import io
+import math
+import time
+import random
+import platform
+import argparse
+import tempfile
+
+from PIL import Image, ImageChops
+import PIL
+
+import watermark_core
+from encoders import encode_image
+from export_engine import ExportEngine, default_worker_count
+from preview_engine import load_proxy
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# 合成图片的种类：(名称, 模式, 格式)
+CORPUS_KINDS = [
+    ("rgb", "RGB", "JPEG"),
+    ("gray", "L", "JPEG"),
+    ("rgb_png", "RGB", "PNG"),
+    ("rgba", "RGBA", "PNG"),
+    ("palette", "P", "PNG"),
+]
+
+# 图片尺寸（百万像素）
+FULL_MEGAPIXELS = [1, 12, 24, 50]
+QUICK_MEGAPIXELS = [1, 4]
+
+# 超过该比例视为性能回退
+DEFAULT_TOLERANCE = 0.15
+
+
+def synthetic_image(width, height, mode, seed):
+    # 用固定种子生成低分辨率随机纹理再放大，内容可复现且压缩难度接近真实照片
+    rng = random.Random(seed)
+    small = (max(2, width // 16), max(2, height // 16))
+
+    def channel():
+        count = small[0] * small[1]
+        data = rng.getrandbits(count * 8).to_bytes(count, 'little')
+        return Image.frombytes('L', small, data).resize((width, height), Image.BICUBIC)
+
+    gradient = Image.linear_gradient('L').resize((width, height))
+    red = ImageChops.blend(channel(), gradient, 0.5)
+    if mode == 'L':
+        return red
+    image = Image.merge('RGB', (red, channel(), ImageChops.invert(gradient)))
+    if mode == 'RGBA':
+        image.putalpha(gradient.transpose(Image.FLIP_LEFT_RIGHT))
+    elif mode == 'P':
+        image = image.quantize(64)
+    return image
+
+
+def build_corpus(folder, megapixels, seed=1234):
+    # 生成（或复用已生成的）合成图片，返回 [(路径, 百万像素), ...]
+    os.makedirs(folder, exist_ok=True)
+    corpus = []
+    for mp in megapixels:
+        width = int(math.sqrt(mp * 1000000 * 3 / 2))
+        height = int(width * 2 / 3)
+        for index, (name, mode, image_format) in enumerate(CORPUS_KINDS):
+            ext = "jpg" if image_format == "JPEG" else "png"
+            path = os.path.join(folder, f"{name}_{mp}mp.{ext}")
+            if not os.path.exists(path):
+                image = synthetic_image(width, height, mode, seed + mp * 100 + index)
+                image.save(path, format=image_format, **({"quality": 90} if image_format == "JPEG" else {}))
+            corpus.append((path, mp))
+    return corpus
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def summarize(samples):
+    return {
+        "count": len(samples),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+        "p50_ms": round(percentile(samples, 0.50) * 1000, 3),
+        "p90_ms": round(percentile(samples, 0.90) * 1000, 3),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 3)
+    }
+
+
+def load_qt_converter():
+    # 有PyQt5时同时测量PIL到QImage的转换；不需要显示器
+    try:
+        from qt_bridge import pil_to_qimage
+    except ImportError:
+        return None
+    return pil_to_qimage
+
+
+def load_thumbnailer():
+    try:
+        from thumbnail_model import make_thumbnail
+        return make_thumbnail
+    except ImportError:
+        return lambda path: load_proxy(path, (120, 120))
+
+
+def measure_stages(corpus, settings, repeat):
+    stages = {}
+    by_size = {}
+    to_qimage = load_qt_converter()
+    make_thumbnail = load_thumbnailer()
+
+    def record(stage, mp, seconds):
+        stages.setdefault(stage, []).append(seconds)
+        by_size.setdefault(str(mp), {}).setdefault(stage, []).append(seconds)
+
+    for _ in range(repeat):
+        for path, mp in corpus:
+            start = time.perf_counter()
+            image = Image.open(path)
+            image.load()
+            record("decode", mp, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            watermarked_image = watermark_core.add_watermark_to_image(image, settings, copy=False)
+            record("watermark", mp, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            encode_image(watermarked_image, io.BytesIO(), settings["output_format"], settings)
+            record("encode", mp, time.perf_counter() - start)
+
+            if to_qimage is not None:
+                start = time.perf_counter()
+                to_qimage(watermarked_image)
+                record("pil_to_qimage", mp, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            make_thumbnail(path)
+            record("thumbnail", mp, time.perf_counter() - start)
+
+    return (
+        {stage: summarize(samples) for stage, samples in stages.items()},
+        {mp: {stage: summarize(samples) for stage, samples in values.items()} for mp, values in by_size.items()}
+    )
+
+
+def measure_export(corpus, settings, workers):
+    with tempfile.TemporaryDirectory() as output_folder:
+        engine = ExportEngine(dict(settings, output_folder=output_folder), workers)
+        file_paths = [path for path, _ in corpus]
+        start = time.perf_counter()
+        succeeded, failures = engine.run(file_paths)
+        seconds = time.perf_counter() - start
+    return {
+        "images": succeeded,
+        "failures": len(failures),
+        "workers": workers,
+        "seconds": round(seconds, 3),
+        "images_per_sec": round(succeeded / seconds, 3) if seconds else None
+    }
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # Linux 上 ru_maxrss 的单位是KB，macOS 上是字节
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1)
+    }
+
+
+def flatten_metrics(results):
+    # 参与基线比较的指标：越小越好的耗时和越大越好的吞吐量
+    metrics = {}
+    for stage, summary in results.get("stages", {}).items():
+        metrics[f"stages.{stage}.p50_ms"] = (summary["p50_ms"], False)
+        metrics[f"stages.{stage}.p90_ms"] = (summary["p90_ms"], False)
+    export = results.get("export")
+    if export and export.get("images_per_sec"):
+        metrics["export.images_per_sec"] = (export["images_per_sec"], True)
+    return metrics
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    # 返回回退的指标列表 [(名称, 基线值, 当前值, 变化比例), ...]
+    current = flatten_metrics(results)
+    previous = flatten_metrics(baseline)
+    regressions = []
+    for name, (value, higher_is_better) in sorted(current.items()):
+        if name not in previous or not previous[name][0]:
+            continue
+        old_value = previous[name][0]
+        change = (value - old_value) / old_value
+        worse = -change if higher_is_better else change
+        status = "回退" if worse > tolerance else "正常"
+        print(f"  {name:40s} {old_value:>10} -> {value:>10} ({change:+.1%}) {status}")
+        if worse > tolerance:
+            regressions.append((name, old_value, value, change))
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="水印渲染和导出性能测试（可在无显示器的Linux上运行）")
+    parser.add_argument("--corpus", default=os.path.join(tempfile.gettempdir(), "watermark_bench_corpus"),
+                        help="合成图片所在文件夹，已存在的图片会被复用")
+    parser.add_argument("--quick", action="store_true", help="只使用小尺寸图片")
+    parser.add_argument("--megapixels", type=int, nargs="+", help="自定义图片尺寸（百万像素）")
+    parser.add_argument("--repeat", type=int, default=3, help="每张图片重复测量的次数")
+    parser.add_argument("-j", "--workers", type=int, default=default_worker_count(), help="导出吞吐量测试的进程数")
+    parser.add_argument("--format", default="JPEG", choices=watermark_core.OUTPUT_FORMATS, help="输出格式")
+    parser.add_argument("--skip-export", action="store_true", help="不测量导出吞吐量")
+    parser.add_argument("-o", "--output", help="把结果保存为JSON")
+    parser.add_argument("--baseline", help="与保存的基线JSON比较")
+    parser.add_argument("--save-baseline", help="把本次结果保存为基线JSON")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="允许的性能变化比例")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    megapixels = args.megapixels or (QUICK_MEGAPIXELS if args.quick else FULL_MEGAPIXELS)
+    settings = dict(watermark_core.DEFAULT_SETTINGS, output_format=args.format)
+
+    print(f"生成测试图片: {args.corpus} ({', '.join(f'{mp}MP' for mp in megapixels)})", file=sys.stderr)
+    corpus = build_corpus(args.corpus, megapixels)
+
+    print("测量各阶段耗时...", file=sys.stderr)
+    stages, by_size = measure_stages(corpus, settings, args.repeat)
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()
+        },
+        "corpus": {"megapixels": megapixels, "images": len(corpus), "format": args.format},
+        "stages": stages,
+        "stages_by_megapixels": by_size
+    }
+    if not args.skip_export:
+        print("测量导出吞吐量...", file=sys.stderr)
+        results["export"] = measure_export(corpus, settings, args.workers)
+    results["peak_rss_mb"] = peak_rss_mb()
+
+    for stage, summary in stages.items():
+        print(f"{stage:15s} p50 {summary['p50_ms']:>9} ms  p90 {summary['p90_ms']:>9} ms  p99 {summary['p99_ms']:>9} ms")
+    if "export" in results:
+        export = results["export"]
+        print(f"导出: {export['images']} 张 / {export['seconds']} 秒 = {export['images_per_sec']} 张/秒（{export['workers']} 进程）")
+    print(f"峰值内存: {results['peak_rss_mb']} MB")
+
+    if args.output:
+        watermark_core.write_json_file(results, args.output)
+    if args.save_baseline:
+        watermark_core.write_json_file(results, args.save_baseline)
+
+    if args.baseline:
+        print(f"与基线比较: {args.baseline}")
+        regressions = compare_with_baseline(results, watermark_core.read_json_file(args.baseline), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} 项指标回退超过 {args.tolerance:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
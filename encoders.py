@@ -0,0 +1,97 @@
+from PIL import Image
+
+# 可能支持的输出格式，实际可用的格式取决于安装的Pillow
+ALL_FORMATS = ["PNG", "JPEG", "WEBP", "AVIF"]
+
+# 速度与体积的取舍
+ENCODER_SPEEDS = ["fast", "balanced", "small"]
+
+# 各档位的默认编码参数，balanced 与早期版本的导出结果一致
+ENCODER_PRESETS = {
+    "fast": {
+        "JPEG": {"quality": 90, "subsampling": "4:2:0", "progressive": False, "optimize": False},
+        "PNG": {"compress_level": 1},
+        "WEBP": {"quality": 80, "method": 0},
+        "AVIF": {"quality": 70, "speed": 10}
+    },
+    "balanced": {
+        "JPEG": {"quality": 95},
+        "PNG": {"compress_level": 6},
+        "WEBP": {"quality": 85, "method": 4},
+        "AVIF": {"quality": 75, "speed": 6}
+    },
+    "small": {
+        "JPEG": {"quality": 85, "subsampling": "4:2:0", "progressive": True, "optimize": True},
+        "PNG": {"compress_level": 9, "optimize": True},
+        "WEBP": {"quality": 80, "method": 6},
+        "AVIF": {"quality": 65, "speed": 2}
+    }
+}
+
+# 允许在模板中覆盖的编码参数
+PROFILE_KEYS = {
+    "JPEG": ["quality", "subsampling", "progressive", "optimize"],
+    "PNG": ["compress_level", "optimize"],
+    "WEBP": ["quality", "method", "lossless"],
+    "AVIF": ["quality", "speed"]
+}
+
+# 不支持透明通道的格式
+OPAQUE_FORMATS = {"JPEG"}
+
+# EXIF方向标签
+EXIF_ORIENTATION = 0x0112
+
+# 输出图片总是RGB或RGBA，只有这些模式的ICC配置文件（RGB色彩空间）可以继续使用
+RGB_MODES = {"RGB", "RGBA", "RGBX", "P", "PA"}
+
+
+def available_formats():
+    Image.init()
+    return [output_format for output_format in ALL_FORMATS if output_format in Image.SAVE]
+
+
+def encoder_options(output_format, settings):
+    # 档位默认参数，再叠加模板中该格式的自定义参数
+    speed = settings.get("encoder_speed", "balanced")
+    options = dict(ENCODER_PRESETS.get(speed, ENCODER_PRESETS["balanced"]).get(output_format, {}))
+    profile = settings.get("encoder_profiles", {}).get(output_format, {})
+    for key in PROFILE_KEYS.get(output_format, []):
+        if key in profile:
+            options[key] = profile[key]
+    return options
+
+
+def source_metadata(image):
+    # 读取需要保留的元数据（EXIF和ICC配置文件）
+    metadata = {}
+    exif = image.info.get("exif")
+    if exif:
+        # 渲染前已按方向标签旋转像素，保留原方向会让看图软件再转一次，这里重置为正常方向
+        # 在副本上修改，image.getexif() 返回的是图片自身缓存的EXIF，之后还要按它旋转像素
+        exif_data = Image.Exif()
+        exif_data.load(exif)
+        if exif_data.get(EXIF_ORIENTATION, 1) != 1:
+            exif_data[EXIF_ORIENTATION] = 1
+            exif = exif_data.tobytes()
+        metadata["exif"] = exif
+    icc_profile = image.info.get("icc_profile")
+    # 灰度、CMYK等图片会被转换为RGB，原来的配置文件描述的是另一种色彩空间，不能继续使用
+    if icc_profile and image.mode in RGB_MODES:
+        metadata["icc_profile"] = icc_profile
+    return metadata
+
+
+def encode_image(image, fp, output_format, settings, metadata=None):
+    # 按格式和编码档位保存图片，fp 可以是路径或文件对象
+    if output_format in OPAQUE_FORMATS and image.mode != "RGB":
+        image = image.convert("RGB")
+    elif output_format in ("WEBP", "AVIF") and image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.mode else "RGB")
+
+    options = encoder_options(output_format, settings)
+    # PNG和AVIF没有指定时会沿用 image.info 中的配置文件，这里明确只写出 metadata 中保留的配置文件
+    options["icc_profile"] = None
+    if metadata and settings.get("keep_metadata", True):
+        options.update(metadata)
+    image.save(fp, format=output_format, **options)
@@ -0,0 +1,121 @@
+import os
+import time
+import sqlite3
+import threading
+from datetime import datetime
+from PIL import Image
+
+from render_cache import LRUCache
+
+EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 36867
+TAG_DATETIME = 306
+
+DATE_FORMATS = ("%Y:%m:%d %H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y:%m:%d")
+
+# 新读取的拍摄日期先缓存在内存中，攒够一定数量或间隔一段时间再批量写入索引，避免每张图片都提交一次
+COMMIT_INTERVAL = 1.0
+COMMIT_BATCH_SIZE = 256
+
+
+def parse_exif_datetime(value):
+    if isinstance(value, bytes):
+        value = value.decode('ascii', 'ignore')
+    if not isinstance(value, str):
+        return None
+    value = value.strip().strip('\x00')
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value[:19], date_format)
+        except ValueError:
+            pass
+    return None
+
+
+def read_capture_date(file_path):
+    # 只读取文件头中的EXIF信息，不解码像素数据
+    with Image.open(file_path) as image:
+        # PNG 的 eXIf 块可能位于图像数据之后，读取它需要解码整幅图片，这里直接跳过
+        if image.format == 'PNG' and 'exif' not in image.info:
+            return None
+        exif = image.getexif()
+        value = exif.get_ifd(EXIF_IFD).get(TAG_DATETIME_ORIGINAL) or exif.get(TAG_DATETIME)
+    return parse_exif_datetime(value)
+
+
+class MetadataIndex:
+    # 拍摄日期索引，保存在SQLite文件中，键为 (绝对路径, 修改时间, 文件大小)
+    def __init__(self, db_path=None, commit_interval=COMMIT_INTERVAL):
+        self._memory = LRUCache(maxsize=4096)
+        self._lock = threading.Lock()
+        self._conn = None
+        self.commit_interval = commit_interval
+        self._updates = []
+        self._last_commit = time.monotonic()
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self._conn = sqlite3.connect(db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS capture_dates ("
+                "path TEXT PRIMARY KEY, mtime REAL, size INTEGER, capture_date TEXT)"
+            )
+            self._conn.commit()
+
+    def get_capture_date(self, file_path):
+        # 返回拍摄日期（datetime），没有EXIF日期时返回None
+        path = os.path.abspath(file_path)
+        stat = os.stat(path)
+        key = (path, stat.st_mtime, stat.st_size)
+
+        cached = self._memory.get(key)
+        if cached is not None:
+            return cached[0]
+
+        found = False
+        value = None
+        if self._conn is not None:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT mtime, size, capture_date FROM capture_dates WHERE path = ?", (path,)
+                ).fetchone()
+            if row is not None and row[0] == stat.st_mtime and row[1] == stat.st_size:
+                found = True
+                value = datetime.fromisoformat(row[2]) if row[2] else None
+
+        if not found:
+            try:
+                value = read_capture_date(path)
+            except Exception:
+                value = None
+            if self._conn is not None:
+                with self._lock:
+                    self._updates.append((path, stat.st_mtime, stat.st_size, value.isoformat() if value else None))
+                    if (len(self._updates) >= COMMIT_BATCH_SIZE
+                            or time.monotonic() - self._last_commit >= self.commit_interval):
+                        self._flush()
+
+        self._memory.put(key, (value,))
+        return value
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._conn is not None and self._updates:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO capture_dates (path, mtime, size, capture_date) VALUES (?, ?, ?, ?)",
+                self._updates
+            )
+            self._conn.commit()
+            self._updates = []
+        self._last_commit = time.monotonic()
+
+    def close(self):
+        if self._conn is not None:
+            with self._lock:
+                self._flush()
+                self._conn.close()
+                self._conn = None
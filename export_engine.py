@@ -0,0 +1,246 @@
+import os
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from PIL import Image
+
+from watermark_core import (
+    get_output_path, output_targets, output_folders, settings_for_file, read_source, render_image_targets,
+    render_image_traced, render_image_file_targets, render_image_file_traced, write_outputs_atomic,
+    estimate_render_memory, configure_image_limits, check_logo
+)
+from export_manifest import ExportManifest, source_key, settings_key
+from export_trace import run_traced
+
+# 增量导出时每完成多少张保存一次清单
+MANIFEST_SAVE_INTERVAL = 200
+
+
+# 读取和写入线程数的默认值
+DEFAULT_IO_WORKERS = 4
+
+# 超过该像素数的图片使用大图模式：不预读源文件，由子进程直接从文件解码并写出结果
+LARGE_IMAGE_PIXELS = 50000000
+
+
+def default_worker_count():
+    return os.cpu_count() or 1
+
+
+def load_source(file_path, settings, large_image_pixels, metadata_index=None):
+    # 先读取图片头估算渲染所需内存；日期模式下同时在读取线程中查询拍摄日期，不占用调度线程
+    # 返回 (源文件数据, 估算内存, 该图片的设置)，大图不预读，源文件数据为None
+    with Image.open(file_path) as image:
+        size, mode = image.size, image.mode
+    file_settings = settings_for_file(settings, file_path, metadata_index)
+    if size[0] * size[1] >= large_image_pixels:
+        return None, estimate_render_memory(size, mode, settings), file_settings
+    data = read_source(file_path)
+    return data, estimate_render_memory(size, mode, settings, len(data)), file_settings
+
+
+class ExportEngine:
+    # 三段流水线：读取线程池预读源文件 -> 进程池解码、加水印、编码 -> 写入线程池原子写出，不依赖Qt
+    # trace 为 ExportTrace 时记录每张图片各阶段的耗时和计数
+    # memory_limit 为同时处理的图片估算内存之和的上限（字节），单张超过上限的图片单独处理
+    def __init__(self, settings, max_workers=None, incremental=False, metadata_index=None, io_workers=None, trace=None,
+                 memory_limit=None, large_image_pixels=LARGE_IMAGE_PIXELS, max_image_pixels=None):
+        # Logo图片不可用时跳过Logo，警告保存在 self.warnings 中
+        self.settings, warning = check_logo(dict(settings))
+        self.warnings = [warning] if warning else []
+        self.trace = trace
+        self.metadata_index = metadata_index
+        self.max_workers = max(1, max_workers or default_worker_count())
+        self.io_workers = max(1, io_workers or DEFAULT_IO_WORKERS)
+        self.incremental = incremental
+        self.memory_limit = memory_limit or None
+        self.large_image_pixels = large_image_pixels
+        self.max_image_pixels = max_image_pixels
+        self.skipped = 0
+        self.memory_in_use = 0
+        self.peak_memory = 0
+        self._cancel_event = threading.Event()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def is_cancelled(self):
+        return self._cancel_event.is_set()
+
+    def plan(self, file_paths):
+        # 串行导出时同名输出会被后面的图片覆盖，这里只保留最后一个来源，保证输出一致
+        # 返回 [(文件路径, (各输出目标的输出路径, ...)), ...]，没有输出配置时只有一个输出路径
+        targets = output_targets(self.settings)
+        jobs = {}
+        for file_path in file_paths:
+            output_paths = tuple(get_output_path(file_path, target) for target in targets)
+            jobs.pop(output_paths, None)
+            jobs[output_paths] = file_path
+        return [(file_path, output_paths) for output_paths, file_path in jobs.items()]
+
+    def submit_stage(self, executor, stage, *args):
+        # 返回提交的任务；启用追踪时任务结果为 (结果, 阶段列表, 计数, cProfile数据)
+        if self.trace is None:
+            function = {
+                "read": load_source, "render": render_image_targets,
+                "render_file": render_image_file_targets, "write": write_outputs_atomic
+            }[stage]
+            return executor.submit(function, *args)
+        if stage == "render":
+            return executor.submit(render_image_traced, *args, self.trace.profile)
+        if stage == "render_file":
+            return executor.submit(render_image_file_traced, *args, self.trace.profile)
+        function = load_source if stage == "read" else write_outputs_atomic
+        return executor.submit(run_traced, function, args)
+
+    def check_manifest(self, jobs, manifest, settings_hash):
+        # 计算源文件哈希；增量导出时跳过源文件和设置都没有变化的图片（所有输出目标都已是最新）
+        # 返回 [(文件路径, 输出路径, 源文件哈希), ...]
+        remaining = []
+        for file_path, output_paths in jobs:
+            try:
+                source = source_key(file_path)
+            except OSError:
+                source = None
+            if (self.incremental and source is not None
+                    and all(manifest.is_current(output_path, source, settings_hash) for output_path in output_paths)):
+                self.skipped += 1
+                continue
+            remaining.append((file_path, output_paths, source))
+        return remaining
+
+    def reserve(self, amount):
+        self.memory_in_use += amount
+        self.peak_memory = max(self.peak_memory, self.memory_in_use)
+
+    def fits(self, amount, rendering):
+        # 没有图片在渲染时总是放行，单张超过上限的图片也能单独完成
+        if self.memory_limit is None or rendering == 0:
+            return True
+        return self.memory_in_use + amount <= self.memory_limit
+
+    def run(self, file_paths, progress_callback=None):
+        # progress_callback(已完成数, 总数, 文件路径, 错误信息或None)
+        # 返回 (成功数, [(文件路径, 错误信息), ...])；增量导出时跳过的数量保存在 self.skipped
+        for folder in output_folders(self.settings):
+            os.makedirs(folder, exist_ok=True)
+        # 读取阶段在本进程中打开图片头，需要和子进程使用相同的像素上限
+        configure_image_limits(self.max_image_pixels)
+
+        # 每次导出都更新清单，之后的增量导出可以据此跳过未变化的图片
+        self.skipped = 0
+        self.memory_in_use = 0
+        self.peak_memory = 0
+        manifest = ExportManifest.load(self.settings["output_folder"])
+        settings_hash = settings_key(self.settings)
+        jobs = self.check_manifest(self.plan(file_paths), manifest, settings_hash)
+        total = len(jobs)
+        done = 0
+        succeeded = 0
+        failures = []
+
+        # 三个阶段中同时处理的图片总数有上限：渲染跟不上时不再预读，内存占用不随批量大小增长
+        max_in_flight = self.max_workers * 2 + self.io_workers * 2
+        job_iter = iter(jobs)
+        # pending: {任务: (阶段, 图片, 占用的估算内存)}；ready: 已读取、等待内存预算的图片
+        pending = {}
+        ready = deque()
+        rendering = 0
+
+        # 使用spawn启动子进程：界面进程中有其他线程，fork可能复制到被占用的锁导致子进程卡死
+        try:
+            with ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=configure_image_limits, initargs=(self.max_image_pixels,)) as renderer, \
+                    ThreadPoolExecutor(max_workers=self.io_workers) as reader, \
+                    ThreadPoolExecutor(max_workers=self.io_workers) as writer:
+                while True:
+                    while (not self.is_cancelled() and len(pending) + len(ready) < max_in_flight
+                           and (self.memory_limit is None or self.memory_in_use < self.memory_limit)):
+                        job = next(job_iter, None)
+                        if job is None:
+                            break
+                        future = self.submit_stage(
+                            reader, "read", job[0], self.settings, self.large_image_pixels, self.metadata_index
+                        )
+                        pending[future] = ("read", job, 0)
+
+                    # 按估算内存放行渲染，同时渲染的图片估算内存之和不超过上限
+                    while ready and not self.is_cancelled():
+                        job, data, estimate, file_settings = ready[0]
+                        held = len(data) if data is not None else 0
+                        if not self.fits(estimate - held, rendering):
+                            break
+                        ready.popleft()
+                        self.memory_in_use -= held
+                        self.reserve(estimate)
+                        file_path, output_paths, _ = job
+                        targets = output_targets(file_settings)
+                        if data is None:
+                            future = self.submit_stage(renderer, "render_file", file_path, output_paths, targets)
+                            pending[future] = ("render_file", job, estimate)
+                        else:
+                            future = self.submit_stage(renderer, "render", data, targets)
+                            pending[future] = ("render", job, estimate)
+                        rendering += 1
+
+                    if not pending:
+                        break
+
+                    finished, _ = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        stage, job, reserved = pending.pop(future)
+                        self.memory_in_use -= reserved
+                        if stage in ("render", "render_file"):
+                            rendering -= 1
+                        file_path, output_paths, source = job
+                        try:
+                            result = future.result()
+                            if self.trace is not None:
+                                result, spans, counters, profile_data = result
+                                self.trace.add(file_path, spans, counters, profile_data)
+                        except Exception as e:
+                            done += 1
+                            failures.append((file_path, str(e)))
+                            if progress_callback:
+                                progress_callback(done, total, file_path, str(e))
+                            continue
+
+                        if stage == "read":
+                            data, estimate, file_settings = result
+                            if data is not None:
+                                self.reserve(len(data))
+                            ready.append((job, data, estimate, file_settings))
+                        elif stage == "render":
+                            size = sum(len(data) for data in result)
+                            self.reserve(size)
+                            pending[self.submit_stage(writer, "write", result, output_paths)] = ("write", job, size)
+                        else:
+                            # 写入完成，或大图在子进程中已直接写出
+                            done += 1
+                            succeeded += 1
+                            if source is not None:
+                                for output_path in output_paths:
+                                    manifest.record(output_path, source, settings_hash)
+                                if succeeded % MANIFEST_SAVE_INTERVAL == 0:
+                                    manifest.save()
+                            if progress_callback:
+                                progress_callback(done, total, file_path, None)
+
+                    if self.is_cancelled():
+                        # 取消尚未开始渲染的图片，已渲染好的图片继续写完
+                        while ready:
+                            _, data, _, _ = ready.popleft()
+                            self.memory_in_use -= len(data) if data is not None else 0
+                        for future, (stage, job, reserved) in list(pending.items()):
+                            if stage != "write" and future.cancel():
+                                del pending[future]
+                                self.memory_in_use -= reserved
+                                if stage != "read":
+                                    rendering -= 1
+        finally:
+            manifest.save()
+            if self.metadata_index is not None:
+                self.metadata_index.flush()
+
+        return succeeded, failures
@@ -0,0 +1,74 @@
+import os
+import json
+import hashlib
+
+MANIFEST_FILE_NAME = ".watermark_manifest.json"
+
+# 不影响输出内容的设置项，不参与设置哈希
+IGNORED_SETTING_KEYS = {"output_folder", "export_workers", "export_memory_limit", "incremental_export"}
+
+
+def source_key(file_path):
+    # 源文件标识：绝对路径 + 修改时间 + 大小
+    stat = os.stat(file_path)
+    identity = f"{os.path.abspath(file_path)}|{stat.st_mtime_ns}|{stat.st_size}"
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+
+def settings_key(settings):
+    effective = {key: value for key, value in settings.items() if key not in IGNORED_SETTING_KEYS}
+    # Logo文件被替换后需要重新导出
+    if settings.get("logo_path"):
+        try:
+            stat = os.stat(settings["logo_path"])
+            effective["logo_file"] = [stat.st_mtime_ns, stat.st_size]
+        except OSError:
+            pass
+    data = json.dumps(effective, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class ExportManifest:
+    # 保存在输出文件夹中的导出清单，记录每个输出文件对应的源文件和设置哈希
+    def __init__(self, output_folder):
+        self.output_folder = output_folder
+        self.path = os.path.join(output_folder, MANIFEST_FILE_NAME)
+        self.entries = {}
+        self.dirty = False
+
+    @classmethod
+    def load(cls, output_folder):
+        manifest = cls(output_folder)
+        try:
+            with open(manifest.path, 'r', encoding='utf-8') as f:
+                manifest.entries = json.load(f).get("outputs", {})
+        except (OSError, ValueError):
+            manifest.entries = {}
+        return manifest
+
+    def entry_key(self, output_path):
+        # 输出文件相对输出文件夹的路径；输出配置的各目标位于子文件夹中，同名文件不会冲突
+        return os.path.relpath(output_path, self.output_folder).replace(os.sep, "/")
+
+    def is_current(self, output_path, source, settings_hash):
+        entry = self.entries.get(self.entry_key(output_path))
+        return (
+            entry is not None
+            and entry.get("source") == source
+            and entry.get("settings") == settings_hash
+            and os.path.exists(output_path)
+        )
+
+    def record(self, output_path, source, settings_hash):
+        self.entries[self.entry_key(output_path)] = {"source": source, "settings": settings_hash}
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        # 先写临时文件再替换，避免中途退出留下损坏的清单
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({"version": 1, "outputs": self.entries}, f, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+        self.dirty = False
@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+# 每张图片的导出状态
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+# 状态更新先缓存在内存中，间隔一段时间再批量提交，避免每张图片都写一次磁盘
+COMMIT_INTERVAL = 1.0
+
+
+class ExportQueue:
+    # 持久化的导出任务队列，保存在单个SQLite文件中
+    # 程序崩溃或中途关闭后，可以从最后一次提交的状态继续导出
+    def __init__(self, db_path, commit_interval=COMMIT_INTERVAL):
+        self.db_path = db_path
+        self.commit_interval = commit_interval
+        self._lock = threading.Lock()
+        self._updates = []
+        self._last_commit = time.monotonic()
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS batches ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, settings TEXT, created REAL, finished INTEGER DEFAULT 0)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "batch_id INTEGER, path TEXT, state TEXT, error TEXT, "
+            "PRIMARY KEY (batch_id, path))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (batch_id, state)")
+        self._conn.commit()
+
+    def create_batch(self, file_paths, settings):
+        # 新建一批导出任务，之前未完成的批次不再继续；返回批次编号
+        with self._lock:
+            self._conn.execute("UPDATE batches SET finished = 1 WHERE finished = 0")
+            cursor = self._conn.execute(
+                "INSERT INTO batches (settings, created) VALUES (?, ?)",
+                (json.dumps(settings, ensure_ascii=False), time.time())
+            )
+            batch_id = cursor.lastrowid
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO jobs (batch_id, path, state) VALUES (?, ?, ?)",
+                ((batch_id, file_path, PENDING) for file_path in file_paths)
+            )
+            self._conn.commit()
+        return batch_id
+
+    def record(self, batch_id, file_path, error=None):
+        # 记录一张图片的导出结果，error 为None表示成功
+        with self._lock:
+            self._updates.append((DONE if error is None else FAILED, error, batch_id, file_path))
+            if time.monotonic() - self._last_commit >= self.commit_interval:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._updates:
+            self._conn.executemany("UPDATE jobs SET state = ?, error = ? WHERE batch_id = ? AND path = ?", self._updates)
+            self._conn.commit()
+            self._updates = []
+        self._last_commit = time.monotonic()
+
+    def finish_batch(self, batch_id):
+        with self._lock:
+            self._flush()
+            self._conn.execute("UPDATE batches SET finished = 1 WHERE id = ?", (batch_id,))
+            self._conn.commit()
+
+    def unfinished_batch(self):
+        # 返回 (批次编号, 导出设置, 剩余数量, 总数)，没有未完成的批次时返回None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, settings FROM batches WHERE finished = 0 ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            batch_id, settings = row
+            remaining = self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE batch_id = ? AND state = ?", (batch_id, PENDING)
+            ).fetchone()[0]
+            total = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE batch_id = ?", (batch_id,)).fetchone()[0]
+        return batch_id, json.loads(settings), remaining, total
+
+    def pending_files(self, batch_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path FROM jobs WHERE batch_id = ? AND state = ? ORDER BY rowid", (batch_id, PENDING)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def failures(self, batch_id):
+        # 返回 [(文件路径, 错误信息), ...]
+        with self._lock:
+            self._flush()
+            return self._conn.execute(
+                "SELECT path, error FROM jobs WHERE batch_id = ? AND state = ? ORDER BY rowid", (batch_id, FAILED)
+            ).fetchall()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._flush()
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+
+# 当前线程的记录器，没有启用追踪时为None，各阶段的计时几乎没有开销
+_local = threading.local()
+
+
+class StageRecorder:
+    # 记录一张图片在当前进程中各阶段的耗时和计数
+    def __init__(self):
+        self.spans = []
+        self.counters = {}
+
+    def add_span(self, name, start, duration):
+        # start 为墙钟时间（秒），不同进程的记录可以放在同一时间轴上
+        self.spans.append((name, start, duration, os.getpid(), threading.get_ident()))
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+def current_recorder():
+    return getattr(_local, "recorder", None)
+
+
+@contextmanager
+def recording(recorder):
+    previous = current_recorder()
+    _local.recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _local.recorder = previous
+
+
+@contextmanager
+def stage(name):
+    recorder = current_recorder()
+    if recorder is None:
+        yield
+        return
+    start = time.time()
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.add_span(name, start, time.perf_counter() - began)
+
+
+def count(name, value=1):
+    recorder = current_recorder()
+    if recorder is not None:
+        recorder.count(name, value)
+
+
+def _cache_counters(before, after):
+    counters = {}
+    for cache_name, stats in after.items():
+        counters[f"{cache_name}.hits"] = stats["hits"] - before[cache_name]["hits"]
+        counters[f"{cache_name}.misses"] = stats["misses"] - before[cache_name]["misses"]
+    return counters
+
+
+class _ProfileData:
+    # 让子进程返回的性能分析数据可以直接交给 pstats.Stats
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def run_traced(function, args, profile=False, cache_stats=None):
+    # 在当前进程中记录 function(*args) 的各阶段耗时，可在子进程中调用
+    # cache_stats 返回各缓存的命中统计，用于计算本次调用的命中次数
+    # 返回 (结果, 阶段列表, 计数, cProfile数据或None)
+    recorder = StageRecorder()
+    before = cache_stats() if cache_stats else None
+    profiler = cProfile.Profile() if profile else None
+    with recording(recorder):
+        if profiler is not None:
+            profiler.enable()
+        try:
+            result = function(*args)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+    if cache_stats:
+        for name, value in _cache_counters(before, cache_stats()).items():
+            recorder.count(name, value)
+    profile_data = None
+    if profiler is not None:
+        profiler.create_stats()
+        profile_data = profiler.stats
+    return result, recorder.spans, recorder.counters, profile_data
+
+
+class ExportTrace:
+    # 汇总一次导出中所有图片的阶段耗时、计数和性能分析数据
+    def __init__(self, profile=False):
+        self.profile = profile
+        self.events = []
+        self.counters = {}
+        self._profile_stats = None
+        self._lock = threading.Lock()
+
+    def add(self, file_path, spans, counters=None, profile_data=None):
+        with self._lock:
+            for name, start, duration, pid, tid in spans:
+                self.events.append({
+                    "file": file_path, "stage": name, "start": start,
+                    "duration": duration, "pid": pid, "tid": tid
+                })
+            for name, value in (counters or {}).items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            if profile_data:
+                data = _ProfileData(profile_data)
+                if self._profile_stats is None:
+                    self._profile_stats = pstats.Stats(data)
+                else:
+                    self._profile_stats.add(data)
+
+    def summary(self):
+        # 返回 {阶段: {"count", "total_ms", "mean_ms", "max_ms"}}
+        stages = {}
+        for event in self.events:
+            stats = stages.setdefault(event["stage"], {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            duration = event["duration"] * 1000
+            stats["count"] += 1
+            stats["total_ms"] += duration
+            stats["max_ms"] = max(stats["max_ms"], duration)
+        for stats in stages.values():
+            stats["mean_ms"] = stats["total_ms"] / stats["count"]
+        return stages
+
+    def format_summary(self):
+        lines = [f"{'阶段':<12}{'次数':>8}{'总计(ms)':>14}{'平均(ms)':>12}{'最长(ms)':>12}"]
+        for name, stats in sorted(self.summary().items(), key=lambda item: -item[1]["total_ms"]):
+            lines.append(
+                f"{name:<12}{stats['count']:>8}{stats['total_ms']:>14.1f}{stats['mean_ms']:>12.2f}{stats['max_ms']:>12.1f}"
+            )
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name}: {value}")
+        return "\n".join(lines)
+
+    def save(self, path):
+        # .jsonl 为每行一个阶段记录，其他扩展名保存为 Chrome trace（chrome://tracing 或 Perfetto 可直接打开）
+        with self._lock:
+            events = list(self.events)
+            counters = dict(self.counters)
+        with open(path, 'w', encoding='utf-8') as f:
+            if path.endswith(".jsonl"):
+                for event in events:
+                    f.write(json.dumps(event, ensure_ascii=False) + "\n")
+                f.write(json.dumps({"counters": counters}, ensure_ascii=False) + "\n")
+            else:
+                trace_events = [{
+                    "name": event["stage"], "cat": "export", "ph": "X",
+                    "ts": event["start"] * 1000000, "dur": event["duration"] * 1000000,
+                    "pid": event["pid"], "tid": event["tid"],
+                    "args": {"file": event["file"]}
+                } for event in events]
+                json.dump({"traceEvents": trace_events, "otherData": {"counters": counters}}, f, ensure_ascii=False)
+
+    def save_profile(self, path):
+        # 保存为 .prof 文件，可用 python -m pstats 或 snakeviz 查看
+        if self._profile_stats is not None:
+            self._profile_stats.dump_stats(path)
+            return True
+        return False
@@ -0,0 +1,113 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from watermark_core import is_image_file
+
+# 扫描时跳过的系统目录和NAS缩略图目录（不区分大小写）
+IGNORED_NAMES = {
+    "$recycle.bin", "system volume information", "__pycache__",
+    "@eadir", "#recycle", "#snapshot", ".thumbnails"
+}
+
+FILE_ATTRIBUTE_HIDDEN = 0x2
+
+
+def is_hidden(entry):
+    if entry.name.startswith('.'):
+        return True
+    if os.name == 'nt':
+        # Windows 下 DirEntry.stat() 不需要额外的系统调用
+        try:
+            return bool(entry.stat(follow_symlinks=False).st_file_attributes & FILE_ATTRIBUTE_HIDDEN)
+        except (OSError, AttributeError):
+            return False
+    return False
+
+
+def normalize_path(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+def scan_directory(path, ignore_paths=frozenset()):
+    # 扫描单个目录（不递归），返回 (图片文件列表, 子目录列表)
+    files = []
+    dirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if is_hidden(entry) or entry.name.lower() in IGNORED_NAMES:
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if normalize_path(entry.path) not in ignore_paths:
+                            dirs.append(entry.path)
+                    elif is_image_file(entry.name) and entry.is_file():
+                        files.append(entry.path)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return files, dirs
+
+
+def scan_folders(folders, batch_size=256, max_workers=8, ignore_paths=(), flush_interval=0.2, cancel_event=None):
+    # 多线程并行扫描各个子目录，以批次的形式逐步返回找到的图片路径
+    # cancel_event 为 threading.Event，设置后最迟在 flush_interval 秒内停止扫描，即使一直没有找到图片
+    ignore_paths = frozenset(normalize_path(path) for path in ignore_paths)
+    batch = []
+    last_flush = time.monotonic()
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = set()
+    try:
+        for folder in folders:
+            if normalize_path(folder) not in ignore_paths:
+                pending.add(executor.submit(scan_directory, folder, ignore_paths))
+
+        while pending:
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            done, pending = wait(pending, timeout=flush_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, dirs = future.result()
+                for sub_dir in dirs:
+                    pending.add(executor.submit(scan_directory, sub_dir, ignore_paths))
+                batch.extend(files)
+
+            # 批次已满或距上次返回已超过一定时间时，先把已找到的结果交给调用方
+            now = time.monotonic()
+            if batch and (len(batch) >= batch_size or now - last_flush >= flush_interval):
+                yield batch
+                batch = []
+                last_flush = now
+
+        if batch:
+            yield batch
+    finally:
+        # 调用方提前停止迭代或取消扫描时，取消尚未开始的扫描，不等待正在读取的目录
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def collect_image_files(paths, ignore_paths=()):
+    # 展开文件和文件夹为图片路径列表，文件夹内按路径排序，结果去重
+    file_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = []
+            for batch in scan_folders([path], ignore_paths=ignore_paths):
+                found.extend(batch)
+            file_paths.extend(sorted(found))
+        elif os.path.isfile(path):
+            file_paths.append(path)
+
+    seen = set()
+    result = []
+    for file_path in file_paths:
+        key = normalize_path(file_path)
+        if key not in seen:
+            seen.add(key)
+            result.append(file_path)
+    return result
@@ -0,0 +1,356 @@
+import os
+import sys
+import time
+import errno
+import select
+import signal
+import struct
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from watermark_core import (
+    is_image_file, get_output_path, output_targets, output_folders, settings_for_file, render_image_file_targets,
+    configure_image_limits, check_logo
+)
+from folder_scanner import scan_directory, collect_image_files, normalize_path
+from export_manifest import ExportManifest, source_key, settings_key
+
+# 文件停止变化多久后认为已经写完（秒）
+DEFAULT_SETTLE_TIME = 0.3
+
+# 轮询间隔，以及轮询模式下完整重新扫描的间隔（秒）
+DEFAULT_POLL_INTERVAL = 0.25
+FULL_SCAN_INTERVAL = 30.0
+
+# 每隔多少秒保存一次导出清单
+MANIFEST_SAVE_INTERVAL = 5.0
+
+# inotify 事件
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0o2000000)
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def file_signature(file_path):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class InotifyWatcher:
+    # Linux下通过inotify接收文件变化事件，不需要反复扫描文件夹
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, folders, ignore_paths=()):
+        import ctypes
+        import ctypes.util
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.folders = list(folders)
+        self.ignore_paths = frozenset(normalize_path(path) for path in ignore_paths)
+        self._dirs = {}
+        # 其他线程通过管道唤醒正在等待事件的 poll()
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_read, False)
+        os.set_blocking(self._wake_write, False)
+        for folder in self.folders:
+            self._add_tree(folder)
+
+    def _add_tree(self, folder):
+        # 监视文件夹及其所有子文件夹，返回其中已有的图片（新建的文件夹可能在监视前已有文件）
+        found = []
+        stack = [folder]
+        while stack:
+            path = stack.pop()
+            if normalize_path(path) in self.ignore_paths:
+                continue
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self.MASK)
+            if wd >= 0:
+                self._dirs[wd] = path
+            files, dirs = scan_directory(path, self.ignore_paths)
+            found.extend(files)
+            stack.extend(dirs)
+        return found
+
+    def poll(self, timeout):
+        # 返回发生变化的图片路径列表
+        readable, _, _ = select.select([self._fd, self._wake_read], [], [], timeout)
+        if self._wake_read in readable:
+            try:
+                os.read(self._wake_read, 4096)
+            except BlockingIOError:
+                pass
+        if self._fd not in readable:
+            return []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+
+        changed = []
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # 事件队列溢出，可能漏掉了事件，重新扫描所有文件夹
+                for folder in self.folders:
+                    changed.extend(collect_image_files([folder], ignore_paths=self.ignore_paths))
+                continue
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            folder = self._dirs.get(wd)
+            if folder is None or not name or name.startswith('.'):
+                continue
+            path = os.path.join(folder, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    changed.extend(self._add_tree(path))
+            elif is_image_file(name):
+                changed.append(path)
+        return changed
+
+    def wake(self):
+        try:
+            os.write(self._wake_write, b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            os.close(self._wake_read)
+            os.close(self._wake_write)
+            self._fd = -1
+
+
+class PollingWatcher:
+    # 没有inotify时的轮询方式：只重新扫描修改时间变化的文件夹，每隔一段时间再完整扫描一次
+    def __init__(self, folders, ignore_paths=(), full_scan_interval=FULL_SCAN_INTERVAL):
+        self.folders = list(folders)
+        self.ignore_paths = frozenset(normalize_path(path) for path in ignore_paths)
+        self.full_scan_interval = full_scan_interval
+        self._dirs = {}
+        self._files = {}
+        self._wake_event = threading.Event()
+        for folder in self.folders:
+            self._scan(folder, [], report=False)
+        self._last_full_scan = time.monotonic()
+
+    def _scan(self, folder, changed, report=True):
+        stack = [folder]
+        while stack:
+            path = stack.pop()
+            if normalize_path(path) in self.ignore_paths:
+                continue
+            try:
+                self._dirs[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                self._dirs.pop(path, None)
+                continue
+            files, dirs = scan_directory(path, self.ignore_paths)
+            for file_path in files:
+                signature = file_signature(file_path)
+                if self._files.get(file_path) != signature:
+                    self._files[file_path] = signature
+                    if report:
+                        changed.append(file_path)
+            # 新出现的子文件夹需要完整扫描
+            stack.extend(sub_dir for sub_dir in dirs if sub_dir not in self._dirs)
+            if not report:
+                stack.extend(sub_dir for sub_dir in dirs if sub_dir in self._dirs)
+
+    def poll(self, timeout):
+        if self._wake_event.wait(timeout):
+            self._wake_event.clear()
+        changed = []
+        full_scan = time.monotonic() - self._last_full_scan >= self.full_scan_interval
+        for path, mtime in list(self._dirs.items()):
+            try:
+                current = os.stat(path).st_mtime_ns
+            except OSError:
+                del self._dirs[path]
+                continue
+            if full_scan or current != mtime:
+                self._scan(path, changed)
+        if full_scan:
+            self._last_full_scan = time.monotonic()
+        return changed
+
+    def wake(self):
+        self._wake_event.set()
+
+    def close(self):
+        pass
+
+
+def create_watcher(folders, ignore_paths=(), polling=False):
+    # 优先使用inotify，不可用时（非Linux、达到监视数量上限等）退回轮询
+    if not polling and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(folders, ignore_paths)
+        except (OSError, AttributeError) as e:
+            print(f"无法使用inotify，改为轮询: {e}", file=sys.stderr)
+    return PollingWatcher(folders, ignore_paths)
+
+
+def init_worker(max_image_pixels):
+    # 子进程忽略 Ctrl+C 和 SIGTERM（服务管理器可能向整个进程组发送），由主进程停止监视并等待正在处理的图片完成
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    configure_image_limits(max_image_pixels)
+
+
+class SettleTracker:
+    # 去抖：文件在 settle_time 内没有新的事件且大小和修改时间不再变化，才认为已经写完
+    def __init__(self, settle_time=DEFAULT_SETTLE_TIME):
+        self.settle_time = settle_time
+        self._pending = {}
+
+    def touch(self, file_path):
+        self._pending[file_path] = (time.monotonic(), file_signature(file_path))
+
+    def next_timeout(self, skip=()):
+        # 距离最早一个文件可以检查是否写完还有多少秒，没有等待中的文件时返回None
+        deadlines = [last_event for file_path, (last_event, _) in self._pending.items() if file_path not in skip]
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) + self.settle_time - time.monotonic())
+
+    def ready(self, skip=()):
+        now = time.monotonic()
+        result = []
+        for file_path, (last_event, signature) in list(self._pending.items()):
+            if file_path in skip or now - last_event < self.settle_time:
+                continue
+            current = file_signature(file_path)
+            if current is None:
+                del self._pending[file_path]
+            elif current != signature:
+                self._pending[file_path] = (now, current)
+            else:
+                del self._pending[file_path]
+                result.append(file_path)
+        return result
+
+    def __len__(self):
+        return len(self._pending)
+
+
+class WatchExporter:
+    # 监视文件夹：新增或修改的图片写完后立即交给常驻进程池，按导出命名规则写到输出文件夹
+    # 已导出且没有变化的图片记录在输出文件夹的清单中，重新启动后不会重复处理
+    def __init__(self, folders, settings, max_workers=None, metadata_index=None, settle_time=DEFAULT_SETTLE_TIME,
+                 poll_interval=DEFAULT_POLL_INTERVAL, polling=False, max_image_pixels=None):
+        self.folders = list(folders)
+        # Logo图片不可用时跳过Logo，警告保存在 self.warnings 中
+        self.settings, warning = check_logo(dict(settings))
+        self.warnings = [warning] if warning else []
+        self.max_workers = max(1, max_workers or os.cpu_count() or 1)
+        self.metadata_index = metadata_index
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.polling = polling
+        self.max_image_pixels = max_image_pixels
+        self._stop_event = threading.Event()
+        self._watcher = None
+
+    def stop(self):
+        self._stop_event.set()
+        if self._watcher is not None:
+            self._watcher.wake()
+
+    def run(self, callback=None, ready_callback=None):
+        # callback(文件路径, [输出路径, ...], 错误信息或None, 耗时)；ready_callback() 在开始监视后调用
+        output_folder = self.settings["output_folder"]
+        for folder in output_folders(self.settings):
+            os.makedirs(folder, exist_ok=True)
+        manifest = ExportManifest.load(output_folder)
+        settings_hash = settings_key(self.settings)
+        tracker = SettleTracker(self.settle_time)
+        watcher = self._watcher = create_watcher(self.folders, ignore_paths=[output_folder], polling=self.polling)
+
+        # 启动时处理监视开始前已有、但还没有导出过的图片
+        for file_path in collect_image_files(self.folders, ignore_paths=[output_folder]):
+            tracker.touch(file_path)
+
+        # 常驻进程池，预先启动所有子进程，新文件到达时不再等待进程启动
+        # 进程池关闭（等待所有任务完成）之后再关闭监视器，任务完成回调不会唤醒已关闭的监视器
+        try:
+            with ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=init_worker, initargs=(self.max_image_pixels,)) as renderer:
+                # 像素上限已由 initializer 设置；这里提交空操作只是为了在开始监视前启动所有子进程并完成导入，
+                # 第一个新文件到达时不必等待进程启动
+                wait([renderer.submit(int) for _ in range(self.max_workers)])
+                if ready_callback:
+                    ready_callback()
+                self._watch(watcher, renderer, tracker, manifest, settings_hash, callback)
+        finally:
+            self._watcher = None
+            watcher.close()
+            manifest.save()
+
+    def _watch(self, watcher, renderer, tracker, manifest, settings_hash, callback):
+        targets = output_targets(self.settings)
+        in_flight = {}
+        last_save = time.monotonic()
+        while not self._stop_event.is_set():
+            # 等待新事件、最早的文件到达稳定时间或某个任务完成，不按固定间隔空转
+            # 轮询模式下还需要按轮询间隔检查文件夹
+            busy = {job[0] for job in in_flight.values()}
+            timeout = tracker.next_timeout(skip=busy)
+            if timeout is None:
+                timeout = self.poll_interval if isinstance(watcher, PollingWatcher) else 1.0
+            elif isinstance(watcher, PollingWatcher):
+                timeout = min(timeout, self.poll_interval)
+            for file_path in watcher.poll(timeout):
+                tracker.touch(file_path)
+
+            # 正在处理的图片再次变化时，等处理完成后重新导出
+            for file_path in tracker.ready(skip=busy):
+                output_paths = [get_output_path(file_path, target) for target in targets]
+                try:
+                    source = source_key(file_path)
+                except OSError:
+                    continue
+                if all(manifest.is_current(output_path, source, settings_hash) for output_path in output_paths):
+                    continue
+                job_targets = output_targets(settings_for_file(self.settings, file_path, self.metadata_index))
+                future = renderer.submit(render_image_file_targets, file_path, output_paths, job_targets)
+                in_flight[future] = (file_path, output_paths, source, time.monotonic())
+                future.add_done_callback(lambda _: watcher.wake())
+
+            for future in [future for future in in_flight if future.done()]:
+                file_path, output_paths, source, started = in_flight.pop(future)
+                try:
+                    future.result()
+                    error = None
+                    for output_path in output_paths:
+                        manifest.record(output_path, source, settings_hash)
+                except Exception as e:
+                    error = str(e)
+                if callback:
+                    callback(file_path, output_paths, error, time.monotonic() - started)
+
+            if manifest.dirty and time.monotonic() - last_save >= MANIFEST_SAVE_INTERVAL:
+                manifest.save()
+                last_save = time.monotonic()
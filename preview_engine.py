@@ -0,0 +1,98 @@
+import os
+import threading
+from PIL import Image
+
+from render_cache import LRUCache
+from watermark_core import has_alpha, image_orientation, oriented_size, apply_orientation
+
+
+def load_proxy(file_path, max_size):
+    # 按预览区域大小解码缩小的代理图，返回 (代理图, 原图尺寸)；代理图和尺寸都按EXIF方向旋转后计算，与导出一致
+    with Image.open(file_path) as image:
+        stored_size = image.size
+        # JPEG 可以直接以 1/2、1/4、1/8 的尺寸解码；JPEG 的EXIF在文件头中，读取方向标签不需要解码
+        if image.format == 'JPEG':
+            image.draft(image.mode, oriented_size(max_size, image_orientation(image)))
+        image.load()
+        orientation = image_orientation(image)
+        full_size = oriented_size(stored_size, orientation)
+        # reduce 只支持常见模式，调色板等模式先转换
+        source = apply_orientation(image, orientation)
+        if source.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            source = source.convert('RGBA' if has_alpha(source) else 'RGB')
+        # 其余格式先用 reduce 整数倍缩小，再做高质量缩放
+        factor = min(source.width // max_size[0], source.height // max_size[1])
+        proxy = source.reduce(factor) if factor >= 2 else source.copy()
+    proxy.thumbnail(max_size, Image.LANCZOS)
+    return proxy, full_size
+
+
+class PreviewCache:
+    # 缓存已解码的预览代理图，键为 (路径, 修改时间, 预览尺寸)
+    def __init__(self, maxsize=8):
+        self.cache = LRUCache(maxsize=maxsize)
+
+    def get(self, file_path, max_size):
+        max_size = (max(1, max_size[0]), max(1, max_size[1]))
+        key = (file_path, os.path.getmtime(file_path), max_size)
+        return self.cache.get_or_create(key, lambda: load_proxy(file_path, max_size))
+
+    def clear(self):
+        self.cache.clear()
+
+
+def map_to_image(pos, label_size, display_size, full_size):
+    # 把预览标签上的坐标换算为原图坐标（预览图在标签中居中显示）
+    offset_x = (label_size[0] - display_size[0]) / 2
+    offset_y = (label_size[1] - display_size[1]) / 2
+    x = (pos[0] - offset_x) * full_size[0] / display_size[0]
+    y = (pos[1] - offset_y) * full_size[1] / display_size[1]
+    # (0, 0) 表示默认位置，因此最小取 1
+    x = min(max(1, round(x)), full_size[0])
+    y = min(max(1, round(y)), full_size[1])
+    return x, y
+
+
+class PreviewMetrics:
+    # 记录后台预览渲染的队列深度和耗时，用于观察预览响应速度
+    def __init__(self, history=100):
+        self.history = history
+        self.submitted = 0
+        self.finished = 0
+        self.dropped = 0
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def record_submit(self):
+        with self._lock:
+            self.submitted += 1
+
+    def record_finish(self, latency, dropped=False):
+        with self._lock:
+            self.finished += 1
+            if dropped:
+                self.dropped += 1
+            else:
+                self.latencies.append(latency)
+                del self.latencies[:-self.history]
+
+    def queue_depth(self):
+        return self.submitted - self.finished
+
+    def stats(self):
+        with self._lock:
+            last = self.latencies[-1] if self.latencies else None
+            latencies = sorted(self.latencies)
+        result = {
+            "queue_depth": self.queue_depth(),
+            "submitted": self.submitted,
+            "dropped": self.dropped,
+            "last_ms": None,
+            "p50_ms": None,
+            "p95_ms": None
+        }
+        if latencies:
+            result["last_ms"] = round(last * 1000, 1)
+            result["p50_ms"] = round(latencies[len(latencies) // 2] * 1000, 1)
+            result["p95_ms"] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1)
+        return result
@@ -0,0 +1,24 @@
+from PyQt5.QtGui import QImage
+
+from watermark_core import has_alpha
+
+# PIL模式 -> (导出数据时使用的原始模式, QImage格式, 每像素字节数)
+# RGB 在Pillow内部按每像素4字节存储，按RGBX导出只需逐行复制，Qt显示32位图片也不必再转换
+QIMAGE_FORMATS = {
+    'RGBA': ('RGBA', QImage.Format_RGBA8888, 4),
+    'RGB': ('RGBX', QImage.Format_RGBX8888, 4),
+    'L': ('L', QImage.Format_Grayscale8, 1),
+}
+
+
+def pil_to_qimage(image):
+    # 将PIL图像转换为QImage，只复制一次像素数据
+    # QImage直接使用这份数据而不再复制，数据保存在QImage对象上，与QImage同生命周期
+    if image.mode not in QIMAGE_FORMATS:
+        image = image.convert('RGBA' if has_alpha(image) else 'RGB')
+    raw_mode, image_format, bytes_per_pixel = QIMAGE_FORMATS[image.mode]
+    data = image.tobytes('raw', raw_mode)
+    # 明确指定每行字节数，宽度不是4的倍数时也不会错位
+    q_image = QImage(data, image.width, image.height, image.width * bytes_per_pixel, image_format)
+    q_image.pil_buffer = data
+    return q_image
@@ -0,0 +1,204 @@
+import os
+import math
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+
+from export_trace import stage
+
+
+class LRUCache:
+    # 有容量上限的LRU缓存，记录命中和未命中次数，可在多线程中使用
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_create(self, key, factory):
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data), "maxsize": self.maxsize}
+
+
+# 字体对象缓存，键为 (字体路径, 字号)
+font_cache = LRUCache(maxsize=32)
+
+# 文本尺寸缓存，键为 (文本, 字体路径, 字号)
+text_extent_cache = LRUCache(maxsize=256)
+
+# 水印图章缓存，键为 (文本, 字体路径, 字号, 不透明度, 颜色)
+sprite_cache = LRUCache(maxsize=64)
+
+# 平铺水印的整幅蒙版缓存，键为 (文本, 字体路径, 字号, 不透明度, 角度, 间距, 图片尺寸)
+# 蒙版与图片等大（50MP 约50MB），同一批图片通常尺寸相同，只保留少量
+pattern_cache = LRUCache(maxsize=2)
+
+# 解码后的图片水印（Logo），键为 (路径, 修改时间, 文件大小)
+logo_cache = LRUCache(maxsize=8)
+
+# 缩放到目标宽度并应用透明度的Logo，键为 (路径, 修改时间, 文件大小, 宽度, 不透明度)
+logo_variant_cache = LRUCache(maxsize=32)
+
+# 仅用于测量文本尺寸的绘图对象
+_measure_draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+_measure_lock = threading.Lock()
+
+
+def _load_font(font_path, font_size):
+    with stage("font"):
+        try:
+            # 尝试加载系统字体
+            return ImageFont.truetype(font_path, font_size)
+        except OSError:
+            # 如果加载失败，使用默认字体（同样缓存，避免每次重新尝试读取磁盘）
+            return ImageFont.load_default()
+
+
+def get_font(font_path, font_size):
+    return font_cache.get_or_create((font_path, font_size), lambda: _load_font(font_path, font_size))
+
+
+def measure_text(text, font_path, font_size):
+    # 返回文本的边界框 (left, top, right, bottom)
+    def measure():
+        font = get_font(font_path, font_size)
+        with _measure_lock:
+            return _measure_draw.textbbox((0, 0), text, font=font)
+
+    return text_extent_cache.get_or_create((text, font_path, font_size), measure)
+
+
+def _render_text_sprite(text, font_path, font_size, alpha, color):
+    left, top, right, bottom = measure_text(text, font_path, font_size)
+    width, height = max(1, right - left), max(1, bottom - top)
+
+    # 先把文字栅格化为灰度蒙版，再按不透明度缩放作为图章的alpha通道
+    mask = Image.new('L', (width, height), 0)
+    ImageDraw.Draw(mask).text((-left, -top), text, font=get_font(font_path, font_size), fill=255)
+    if alpha < 255:
+        mask = mask.point(lambda value: value * alpha // 255)
+
+    sprite = Image.new('RGBA', (width, height), tuple(color) + (0,))
+    sprite.putalpha(mask)
+    return sprite, (left, top)
+
+
+def get_text_sprite(text, font_path, font_size, alpha, color):
+    # 返回 (RGBA图章, 相对绘制位置的偏移)，同样的文字只栅格化一次
+    key = (text, font_path, font_size, alpha, tuple(color))
+    return sprite_cache.get_or_create(key, lambda: _render_text_sprite(text, font_path, font_size, alpha, color))
+
+
+def _paste_lighter(mask, tile, x, y):
+    # 把图块取较大值合并到蒙版中，超出边界的部分被裁掉；相邻图块的透明角重叠时不会互相覆盖
+    left, top = max(0, x), max(0, y)
+    right, bottom = min(mask.width, x + tile.width), min(mask.height, y + tile.height)
+    if right <= left or bottom <= top:
+        return
+    box = (left, top, right, bottom)
+    part = tile.crop((left - x, top - y, right - x, bottom - y))
+    mask.paste(ImageChops.lighter(mask.crop(box), part), box)
+
+
+def _render_pattern_mask(text, font_path, font_size, alpha, angle, spacing, size):
+    # 旋转后的文字只栅格化一次，再沿文字方向和垂直方向铺满整幅蒙版，隔行错开半个间隔
+    sprite, _ = get_text_sprite(text, font_path, font_size, alpha, (0, 0, 0))
+    tile = sprite.getchannel('A').rotate(angle, resample=Image.BICUBIC, expand=True)
+
+    step_x = sprite.width + spacing
+    step_y = sprite.height + spacing
+    radians = math.radians(angle)
+    ux, uy = math.cos(radians) * step_x, -math.sin(radians) * step_x
+    vx, vy = math.sin(radians) * step_y, math.cos(radians) * step_y
+
+    mask = Image.new('L', size, 0)
+    center_x, center_y = size[0] / 2 - tile.width / 2, size[1] / 2 - tile.height / 2
+    reach = math.hypot(size[0], size[1]) / 2 + max(tile.size)
+    columns = int(reach // step_x) + 1
+    rows = int(reach // step_y) + 1
+    for row in range(-rows, rows + 1):
+        shift = 0.5 if row % 2 else 0.0
+        for column in range(-columns, columns + 1):
+            i = column + shift
+            x = round(center_x + i * ux + row * vx)
+            y = round(center_y + i * uy + row * vy)
+            _paste_lighter(mask, tile, x, y)
+    return mask
+
+
+def get_pattern_mask(text, font_path, font_size, alpha, angle, spacing, size):
+    # 返回与图片等大的平铺水印蒙版（L模式），同样的设置和尺寸只生成一次
+    key = (text, font_path, font_size, alpha, angle, spacing, tuple(size))
+    return pattern_cache.get_or_create(
+        key, lambda: _render_pattern_mask(text, font_path, font_size, alpha, angle, spacing, tuple(size))
+    )
+
+
+def _load_logo(logo_path):
+    with stage("logo"):
+        with Image.open(logo_path) as logo:
+            return logo.convert('RGBA')
+
+
+def _scale_logo(logo, width, alpha):
+    # Pillow 对RGBA缩放时在预乘alpha空间中插值，透明边缘不会出现黑边
+    height = max(1, round(logo.height * width / logo.width))
+    scaled = logo.resize((width, height), Image.LANCZOS, reducing_gap=3.0) if (width, height) != logo.size else logo.copy()
+    if alpha < 255:
+        scaled.putalpha(scaled.getchannel('A').point(lambda value: value * alpha // 255))
+    return scaled
+
+
+def get_logo(logo_path, width, alpha):
+    # 返回缩放到指定宽度的RGBA Logo；原图只解码一次，每种尺寸只缩放一次
+    stat = os.stat(logo_path)
+    source_key = (os.path.abspath(logo_path), stat.st_mtime_ns, stat.st_size)
+    width = max(1, int(width))
+
+    def scale():
+        logo = logo_cache.get_or_create(source_key, lambda: _load_logo(logo_path))
+        return _scale_logo(logo, width, alpha)
+
+    return logo_variant_cache.get_or_create(source_key + (width, alpha), scale)
+
+
+def cache_stats():
+    return {
+        "font": font_cache.stats(),
+        "text_extent": text_extent_cache.stats(),
+        "sprite": sprite_cache.stats(),
+        "pattern": pattern_cache.stats(),
+        "logo": logo_variant_cache.stats()
+    }
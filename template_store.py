@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+# 模板库文件名，位于模板文件夹中
+TEMPLATE_STORE_FILE_NAME = "templates.db"
+
+
+def default_store_path(template_folder):
+    return os.path.join(template_folder, TEMPLATE_STORE_FILE_NAME)
+
+
+class TemplateStore:
+    # 保存在单个SQLite文件中的模板库：模板列表只读取名称索引，模板内容在选中时才读取
+    # 新增、修改和删除只更新对应的一行，不需要重新扫描整个模板文件夹
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS templates (name TEXT PRIMARY KEY, body TEXT, updated REAL)"
+        )
+        # 已导入的模板JSON文件，文件没有变化时不再重复导入；在模板库中删除的模板也不会被重新导入
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS imported_files (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER)"
+        )
+        self._conn.commit()
+
+    def names(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT name FROM templates ORDER BY name").fetchall()
+        return [row[0] for row in rows]
+
+    def get(self, name):
+        # 返回模板字典，不存在时返回None
+        entry = self.get_entry(name)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, name):
+        # 返回 (模板字典, 修改时间)，调用方可以按修改时间缓存由模板生成的设置
+        with self._lock:
+            row = self._conn.execute("SELECT body, updated FROM templates WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def updated(self, name):
+        # 只读取修改时间，不解析模板内容；模板不存在时返回None
+        with self._lock:
+            row = self._conn.execute("SELECT updated FROM templates WHERE name = ?", (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, name, template):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO templates (name, body, updated) VALUES (?, ?, ?)",
+                (name, json.dumps(template, ensure_ascii=False), time.time())
+            )
+            self._conn.commit()
+
+    def delete(self, name):
+        with self._lock:
+            self._conn.execute("DELETE FROM templates WHERE name = ?", (name,))
+            self._conn.commit()
+
+    def import_files(self, file_paths, overwrite=True):
+        # 批量导入模板JSON文件，模板名称为文件名；在同一个事务中写入
+        # 返回 (导入数量, [(文件路径, 错误信息), ...])
+        templates = []
+        files = []
+        failures = []
+        now = time.time()
+        for file_path in file_paths:
+            try:
+                stat = os.stat(file_path)
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    template = json.load(f)
+                if not isinstance(template, dict):
+                    raise ValueError("模板内容不是JSON对象")
+            except (OSError, ValueError) as e:
+                failures.append((file_path, str(e)))
+                continue
+            name = os.path.splitext(os.path.basename(file_path))[0]
+            templates.append((name, json.dumps(template, ensure_ascii=False), now))
+            files.append((os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size))
+
+        with self._lock:
+            verb = "INSERT OR REPLACE" if overwrite else "INSERT OR IGNORE"
+            self._conn.executemany(f"{verb} INTO templates (name, body, updated) VALUES (?, ?, ?)", templates)
+            self._conn.executemany("INSERT OR REPLACE INTO imported_files (path, mtime, size) VALUES (?, ?, ?)", files)
+            self._conn.commit()
+        return len(templates), failures
+
+    def sync_folder(self, folder):
+        # 导入文件夹中新增或修改过的模板JSON文件，已导入且没有变化的文件只检查修改时间，不读取内容
+        # 返回 (导入数量, [(文件路径, 错误信息), ...])
+        try:
+            entries = [entry for entry in os.scandir(folder) if entry.name.endswith(".json") and entry.is_file()]
+        except OSError:
+            return 0, []
+        with self._lock:
+            imported = {
+                path: (mtime, size)
+                for path, mtime, size in self._conn.execute("SELECT path, mtime, size FROM imported_files")
+            }
+        changed = []
+        for entry in entries:
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if imported.get(os.path.abspath(entry.path)) != (stat.st_mtime_ns, stat.st_size):
+                changed.append(entry.path)
+        if not changed:
+            return 0, []
+        return self.import_files(changed)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
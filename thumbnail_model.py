@@ -0,0 +1,127 @@
+import os
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QObject, QRunnable, QThreadPool, pyqtSignal
+from PyQt5.QtGui import QIcon, QImage, QPixmap
+
+from preview_engine import load_proxy
+from qt_bridge import pil_to_qimage
+from render_cache import LRUCache
+from thumbnail_store import encode_thumbnail
+
+THUMBNAIL_SIZE = 120
+
+
+def make_thumbnail(file_path, size=THUMBNAIL_SIZE, store=None):
+    # 优先从磁盘缓存读取，否则以缩小的尺寸解码图片；返回独立持有数据的QImage
+    if store is not None:
+        data = store.get(file_path)
+        if data is not None:
+            image = QImage.fromData(data)
+            if not image.isNull():
+                return image
+
+    proxy, _ = load_proxy(file_path, (size, size))
+    if store is not None:
+        store.put(file_path, encode_thumbnail(proxy))
+    return pil_to_qimage(proxy)
+
+
+class ThumbnailSignals(QObject):
+    loaded = pyqtSignal(str, object)
+
+
+class ThumbnailTask(QRunnable):
+    def __init__(self, file_path, signals, store=None):
+        super().__init__()
+        self.file_path = file_path
+        self.signals = signals
+        self.store = store
+
+    def run(self):
+        try:
+            image = make_thumbnail(self.file_path, store=self.store)
+        except Exception:
+            image = None
+        self.signals.loaded.emit(self.file_path, image)
+
+
+class ImageListModel(QAbstractListModel):
+    # 图片列表模型：缩略图只在视图需要显示时才在后台生成
+    def __init__(self, parent=None, max_icons=2000, store=None):
+        super().__init__(parent)
+        self.store = store
+        self.paths = []
+        self.path_index = {}
+        self.icons = LRUCache(maxsize=max_icons)
+        self.pending = set()
+        self.request_counter = 0
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max(2, (os.cpu_count() or 2) // 2))
+        self.signals = ThumbnailSignals(self)
+        self.signals.loaded.connect(self.on_thumbnail_loaded)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.paths)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or not 0 <= index.row() < len(self.paths):
+            return None
+        file_path = self.paths[index.row()]
+
+        if role == Qt.DisplayRole:
+            return os.path.basename(file_path)
+        if role == Qt.ToolTipRole:
+            return file_path
+        if role == Qt.TextAlignmentRole:
+            return Qt.AlignHCenter | Qt.AlignBottom
+        if role == Qt.DecorationRole:
+            icon = self.icons.get(file_path)
+            if icon is None:
+                # 视图只为可见的行请求图标，这里才开始生成缩略图
+                self.request_thumbnail(file_path)
+            return icon
+        return None
+
+    def add_paths(self, file_paths):
+        # 用字典索引去重，返回新增的数量
+        new_paths = []
+        for file_path in file_paths:
+            if file_path not in self.path_index:
+                self.path_index[file_path] = len(self.paths) + len(new_paths)
+                new_paths.append(file_path)
+
+        if new_paths:
+            first = len(self.paths)
+            self.beginInsertRows(QModelIndex(), first, first + len(new_paths) - 1)
+            self.paths.extend(new_paths)
+            self.endInsertRows()
+        return len(new_paths)
+
+    def contains(self, file_path):
+        return file_path in self.path_index
+
+    def request_thumbnail(self, file_path):
+        if file_path in self.pending:
+            return
+        self.pending.add(file_path)
+        # 后请求的优先处理，滚动后当前可见的行会先显示出来
+        self.request_counter += 1
+        self.pool.start(ThumbnailTask(file_path, self.signals, self.store), self.request_counter)
+
+    def on_thumbnail_loaded(self, file_path, image):
+        self.pending.discard(file_path)
+        row = self.path_index.get(file_path)
+        if row is None:
+            return
+
+        # 无法生成缩略图时使用空图标，避免反复重试
+        icon = QIcon(QPixmap.fromImage(image)) if image is not None else QIcon()
+        self.icons.put(file_path, icon)
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+    def shutdown(self):
+        self.pool.clear()
+        self.pool.waitForDone()
+        if self.store is not None:
+            self.store.close()
+            self.store = None
@@ -0,0 +1,116 @@
+import os
+import io
+import time
+import sqlite3
+import threading
+
+# 缩略图缓存默认上限
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# 缩略图生成方式改变时递增，旧版本的缓存全部作废（2：按EXIF方向旋转）
+THUMBNAIL_VERSION = 2
+
+
+def encode_thumbnail(image):
+    # 缩略图统一保存为PNG，保留透明通道
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+class ThumbnailStore:
+    # 保存在单个SQLite文件中的缩略图缓存，键为 (绝对路径, 修改时间, 文件大小)
+    def __init__(self, db_path, max_bytes=DEFAULT_MAX_BYTES):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS thumbnails ("
+            "path TEXT PRIMARY KEY, mtime REAL, size INTEGER, "
+            "data BLOB, bytes INTEGER, last_used REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS thumbnails_last_used ON thumbnails (last_used)")
+        self._conn.commit()
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] < THUMBNAIL_VERSION:
+            self._conn.execute("DELETE FROM thumbnails")
+            self._conn.execute(f"PRAGMA user_version = {THUMBNAIL_VERSION}")
+            self._conn.commit()
+        self.total_bytes = self._conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM thumbnails").fetchone()[0]
+
+    def get(self, file_path):
+        # 返回缓存的缩略图数据；文件已修改或已删除时使缓存失效并返回None
+        path = os.path.abspath(file_path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.remove(path)
+            return None
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT mtime, size, data FROM thumbnails WHERE path = ?", (path,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[0] != stat.st_mtime or row[1] != stat.st_size:
+                self._delete(path)
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE thumbnails SET last_used = ? WHERE path = ?", (time.time(), path))
+            self._conn.commit()
+            return row[2]
+
+    def put(self, file_path, data):
+        path = os.path.abspath(file_path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+
+        with self._lock:
+            self._delete(path)
+            self._conn.execute(
+                "INSERT INTO thumbnails (path, mtime, size, data, bytes, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (path, stat.st_mtime, stat.st_size, data, len(data), time.time())
+            )
+            self.total_bytes += len(data)
+            self._evict()
+            self._conn.commit()
+
+    def remove(self, file_path):
+        with self._lock:
+            self._delete(os.path.abspath(file_path))
+            self._conn.commit()
+
+    def _delete(self, path):
+        row = self._conn.execute("SELECT bytes FROM thumbnails WHERE path = ?", (path,)).fetchone()
+        if row is not None:
+            self._conn.execute("DELETE FROM thumbnails WHERE path = ?", (path,))
+            self.total_bytes -= row[0]
+
+    def _evict(self):
+        # 超出上限时按最近最少使用的顺序删除，每次删除约十分之一
+        while self.total_bytes > self.max_bytes:
+            count = self._conn.execute("SELECT COUNT(*) FROM thumbnails").fetchone()[0]
+            if count == 0:
+                self.total_bytes = 0
+                break
+            rows = self._conn.execute(
+                "SELECT path, bytes FROM thumbnails ORDER BY last_used LIMIT ?", (max(1, count // 10),)
+            ).fetchall()
+            self._conn.executemany("DELETE FROM thumbnails WHERE path = ?", [(row[0],) for row in rows])
+            self.total_bytes -= sum(row[1] for row in rows)
+
+    def stats(self):
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM thumbnails").fetchone()[0]
+        return {"count": count, "bytes": self.total_bytes, "max_bytes": self.max_bytes}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,17 +1,147 @@
 import sys
 import os
-import json
+import time
+import threading
+import multiprocessing
 from datetime import datetime
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QLabel,
-    QPushButton, QFileDialog, QListWidget, QListWidgetItem, QSlider, 
+    QPushButton, QFileDialog, QListWidget, QSlider, 
     QTabWidget, QLineEdit, QComboBox, QCheckBox, QGroupBox, QGridLayout,
     QMessageBox, QSplitter, QFrame, QAction, QMenu, QMenuBar, QToolBar,
-    QInputDialog
+    QInputDialog, QSpinBox, QListView
 )
-from PyQt5.QtGui import QPixmap, QPainter, QColor, QFont, QIcon, QImage
-from PyQt5.QtCore import Qt, QPoint, QSize
-from PIL import Image, ImageDraw, ImageFont, ImageQt
+from PyQt5.QtGui import QPixmap, QPainter, QColor, QFont
+from PyQt5.QtCore import (
+    Qt, QPoint, QSize, QThread, QTimer, QObject, QRunnable, QThreadPool, pyqtSignal
+)
+from PIL import Image
+
+import watermark_core
+import encoders
+from export_engine import ExportEngine, default_worker_count
+from preview_engine import PreviewCache, PreviewMetrics, map_to_image
+from thumbnail_model import ImageListModel, THUMBNAIL_SIZE
+from thumbnail_store import ThumbnailStore
+from folder_scanner import scan_folders
+from exif_date import MetadataIndex
+from export_trace import ExportTrace
+from export_queue import ExportQueue
+from template_store import TemplateStore, default_store_path
+from qt_bridge import pil_to_qimage
+
+
+class ExportThread(QThread):
+    # 在后台线程中驱动导出引擎，通过信号把进度发回界面
+    progress = pyqtSignal(int, int, str, str)
+    export_finished = pyqtSignal(int, int, list, bool)
+
+    # queue 为 ExportQueue 时记录每张图片的导出状态，batch_id 不为None时继续之前未完成的批次
+    def __init__(self, file_paths, settings, max_workers, incremental=False, metadata_index=None, trace=None,
+                 memory_limit=None, queue=None, batch_id=None, max_image_pixels=None, parent=None):
+        super().__init__(parent)
+        self.file_paths = list(file_paths)
+        self.engine = ExportEngine(
+            settings, max_workers, incremental, metadata_index, trace=trace, memory_limit=memory_limit,
+            max_image_pixels=max_image_pixels
+        )
+        self.queue = queue
+        self.batch_id = batch_id
+
+    def cancel(self):
+        self.engine.cancel()
+
+    def run(self):
+        total = len(self.file_paths)
+        try:
+            if self.queue is not None and self.batch_id is None:
+                # 只登记实际会导出的图片（同名输出只保留最后一个来源）
+                planned = [file_path for file_path, _ in self.engine.plan(self.file_paths)]
+                self.batch_id = self.queue.create_batch(planned, self.engine.settings)
+            succeeded, failures = self.engine.run(self.file_paths, self.on_progress)
+        except Exception as e:
+            succeeded, failures = 0, [("", str(e))]
+        cancelled = self.engine.is_cancelled()
+        if self.queue is not None and self.batch_id is not None:
+            # 取消或关闭程序时保留批次，下次启动时可以继续
+            if cancelled:
+                self.queue.flush()
+            else:
+                # 报告中包含继续导出之前失败的图片
+                failures = self.queue.failures(self.batch_id) + [item for item in failures if not item[0]]
+                self.queue.finish_batch(self.batch_id)
+        self.export_finished.emit(succeeded, total, failures, cancelled)
+
+    def on_progress(self, done, total, file_path, error):
+        if self.queue is not None and self.batch_id is not None:
+            self.queue.record(self.batch_id, file_path, error)
+        self.progress.emit(done, total, file_path, error or "")
+
+
+class ScanThread(QThread):
+    # 在后台扫描文件夹，分批把找到的图片发回界面
+    batch_found = pyqtSignal(list)
+    scan_finished = pyqtSignal(int, bool)
+
+    def __init__(self, folders, ignore_paths=(), parent=None):
+        super().__init__(parent)
+        self.folders = list(folders)
+        self.ignore_paths = list(ignore_paths)
+        self._cancel_event = threading.Event()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def run(self):
+        found = 0
+        batches = scan_folders(self.folders, ignore_paths=self.ignore_paths, cancel_event=self._cancel_event)
+        try:
+            for batch in batches:
+                if self._cancel_event.is_set():
+                    break
+                found += len(batch)
+                self.batch_found.emit(batch)
+        finally:
+            batches.close()
+        self.scan_finished.emit(found, self._cancel_event.is_set())
+
+
+class PreviewSignals(QObject):
+    rendered = pyqtSignal(int, object, tuple, float)
+    failed = pyqtSignal(int, str, float)
+
+
+class PreviewTask(QRunnable):
+    # 在线程池中解码并渲染预览；开始前已过期的请求直接放弃
+    def __init__(self, generation, current_generation, file_path, label_size, settings, cache, signals,
+                 metadata_index=None):
+        super().__init__()
+        self.generation = generation
+        self.current_generation = current_generation
+        self.file_path = file_path
+        self.label_size = label_size
+        self.settings = settings
+        self.cache = cache
+        self.signals = signals
+        self.metadata_index = metadata_index
+
+    def run(self):
+        start = time.perf_counter()
+        if self.generation != self.current_generation():
+            self.signals.failed.emit(self.generation, "", 0.0)
+            return
+        try:
+            proxy, full_size = self.cache.get(self.file_path, self.label_size)
+            settings = watermark_core.settings_for_file(self.settings, self.file_path, self.metadata_index)
+            preview_image = watermark_core.add_watermark_to_image(
+                proxy, settings, full_size=full_size
+            )
+            # 在后台线程中转换为QImage，界面线程只需生成QPixmap
+            q_image = pil_to_qimage(preview_image)
+            self.signals.rendered.emit(self.generation, q_image, full_size, time.perf_counter() - start)
+        except Exception as e:
+            self.signals.failed.emit(self.generation, str(e), time.perf_counter() - start)
+
 
 class WatermarkApp(QMainWindow):
     def __init__(self):
@@ -30,15 +160,51 @@ class WatermarkApp(QMainWindow):
         self.file_naming_rule = "original"  # original, prefix, suffix
         self.custom_prefix = "wm_"
         self.custom_suffix = "_watermarked"
-        self.templates = {}
+        self.watermark_mode = "text"  # text, date
+        self.date_format = "%Y-%m-%d"
+        self.date_fallback = "mtime"  # mtime, none
+        self.watermark_layout = "single"  # single, tiled
+        self.tile_angle = 30
+        self.tile_spacing = 100
+        self.logo_path = ""
+        self.logo_scale = 20
+        self.logo_opacity = 0
+        self.logo_position = "top_left"
+        self.encoder_speed = "balanced"  # fast, balanced, small
+        self.encoder_profiles = {}
+        self.keep_metadata = True
+        self.output_profiles = []  # 输出配置：一次导出生成的多个尺寸/格式目标，来自模板或设置文件
+        self.export_workers = default_worker_count()
+        self.export_memory_limit = 0  # MB，0 表示不限制
+        self.max_megapixels = 0  # 允许处理的最大像素数（百万），0 表示使用Pillow的默认上限
+        self.incremental_export = False
+        self.trace_export = False
+        self.export_thread = None
+        self.scan_threads = []
+        self.preview_cache = PreviewCache()
+        self.preview_generation = 0
+        self.logo_warning = None
+        self.preview_metrics = PreviewMetrics()
+        self.preview_pool = QThreadPool(self)
+        self.preview_pool.setMaxThreadCount(2)
+        self.preview_signals = PreviewSignals(self)
+        self.preview_signals.rendered.connect(self.on_preview_rendered)
+        self.preview_signals.failed.connect(self.on_preview_failed)
+        self.preview_full_size = None
+        self.preview_display_size = None
         self.template_folder = os.path.join(os.getcwd(), "templates")
+        self.cache_folder = os.path.join(os.getcwd(), "cache")
+        self.metadata_index = self.open_metadata_index()
+        self.export_queue = self.open_export_queue()
         
         # 确保必要的文件夹存在
         os.makedirs(self.output_folder, exist_ok=True)
         os.makedirs(self.template_folder, exist_ok=True)
+        self.template_store = self.open_template_store()
         
         # 加载上次保存的设置
         self.load_settings()
+        watermark_core.configure_image_limits(self.max_image_pixels())
         
         # 创建界面
         self.init_ui()
@@ -48,6 +214,10 @@ class WatermarkApp(QMainWindow):
         
         # 启用拖放
         self.setAcceptDrops(True)
+        
+        # 窗口显示后导入模板文件夹中新增的JSON模板，并检查是否有上次未完成的导出
+        QTimer.singleShot(0, self.sync_template_folder)
+        QTimer.singleShot(0, self.check_unfinished_export)
     
     def init_ui(self):
         # 主布局
@@ -78,19 +248,30 @@ class WatermarkApp(QMainWindow):
         list_header_layout.addWidget(add_folder_button)
         left_layout.addLayout(list_header_layout)
         
-        # 图片列表控件
-        self.image_list = QListWidget()
-        self.image_list.setViewMode(QListWidget.IconMode)
-        self.image_list.setIconSize(QSize(120, 120))
-        self.image_list.setResizeMode(QListWidget.Adjust)
+        # 图片列表控件：模型只保存路径，缩略图在显示时由后台线程生成
+        self.image_model = ImageListModel(self, store=self.open_thumbnail_store())
+        self.image_paths = self.image_model.paths  # 与模型共用同一个列表
+        self.image_list = QListView()
+        self.image_list.setModel(self.image_model)
+        self.image_list.setViewMode(QListView.IconMode)
+        self.image_list.setIconSize(QSize(THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        self.image_list.setResizeMode(QListView.Adjust)
         self.image_list.setSpacing(10)
-        self.image_list.itemClicked.connect(self.on_image_selected)
+        self.image_list.setUniformItemSizes(True)
+        self.image_list.setLayoutMode(QListView.Batched)
+        self.image_list.clicked.connect(self.on_image_selected)
         left_layout.addWidget(self.image_list)
         
         # 导出按钮
-        export_button = QPushButton("导出所有图片")
-        export_button.clicked.connect(self.export_all_images)
-        left_layout.addWidget(export_button)
+        export_buttons_layout = QHBoxLayout()
+        self.export_button = QPushButton("导出所有图片")
+        self.export_button.clicked.connect(self.export_all_images)
+        export_buttons_layout.addWidget(self.export_button)
+        self.cancel_export_button = QPushButton("取消导出")
+        self.cancel_export_button.setEnabled(False)
+        self.cancel_export_button.clicked.connect(self.cancel_export)
+        export_buttons_layout.addWidget(self.cancel_export_button)
+        left_layout.addLayout(export_buttons_layout)
         
         # 将左侧部件添加到分割器
         main_splitter.addWidget(left_widget)
@@ -110,6 +291,12 @@ class WatermarkApp(QMainWindow):
         self.preview_label.mouseReleaseEvent = self.on_preview_release
         self.dragging = False
         
+        # 合并短时间内的多次修改，最多每16毫秒刷新一次预览
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(16)
+        self.preview_timer.timeout.connect(self.update_preview)
+        
         center_layout.addWidget(self.preview_label)
         
         # 预设位置按钮
@@ -143,10 +330,61 @@ class WatermarkApp(QMainWindow):
         text_input_layout = QHBoxLayout()
         text_input_layout.addWidget(QLabel("水印文本："))
         self.text_input = QLineEdit(self.watermark_text)
+        self.text_input.setEnabled(self.watermark_mode == "text")
         self.text_input.textChanged.connect(self.on_text_changed)
         text_input_layout.addWidget(self.text_input)
         text_group_layout.addLayout(text_input_layout)
         
+        # 水印内容：自定义文本或每张图片的拍摄日期
+        mode_layout = QHBoxLayout()
+        mode_layout.addWidget(QLabel("水印内容："))
+        self.mode_combo = QComboBox()
+        self.mode_combo.addItems(["自定义文本", "拍摄日期"])
+        self.mode_combo.setCurrentIndex(self.watermark_mode_index(self.watermark_mode))
+        self.mode_combo.currentIndexChanged.connect(self.on_mode_changed)
+        mode_layout.addWidget(self.mode_combo)
+        text_group_layout.addLayout(mode_layout)
+        
+        date_format_layout = QHBoxLayout()
+        date_format_layout.addWidget(QLabel("日期格式："))
+        self.date_format_input = QLineEdit(self.date_format)
+        self.date_format_input.textChanged.connect(self.on_date_format_changed)
+        date_format_layout.addWidget(self.date_format_input)
+        text_group_layout.addLayout(date_format_layout)
+        
+        self.date_fallback_check = QCheckBox("无拍摄日期时使用文件修改时间")
+        self.date_fallback_check.setChecked(self.date_fallback == "mtime")
+        self.date_fallback_check.toggled.connect(self.on_date_fallback_changed)
+        text_group_layout.addWidget(self.date_fallback_check)
+        
+        # 水印布局：单个水印或倾斜平铺（防裁剪）
+        layout_layout = QHBoxLayout()
+        layout_layout.addWidget(QLabel("水印布局："))
+        self.layout_combo = QComboBox()
+        self.layout_combo.addItems(["单个", "倾斜平铺"])
+        self.layout_combo.setCurrentIndex(self.watermark_layout_index(self.watermark_layout))
+        self.layout_combo.currentIndexChanged.connect(self.on_layout_changed)
+        layout_layout.addWidget(self.layout_combo)
+        text_group_layout.addLayout(layout_layout)
+        
+        tile_layout = QHBoxLayout()
+        tile_layout.addWidget(QLabel("角度："))
+        self.tile_angle_spin = QSpinBox()
+        self.tile_angle_spin.setRange(-90, 90)
+        self.tile_angle_spin.setSuffix("°")
+        self.tile_angle_spin.setValue(self.tile_angle)
+        self.tile_angle_spin.valueChanged.connect(self.on_tile_angle_changed)
+        tile_layout.addWidget(self.tile_angle_spin)
+        tile_layout.addWidget(QLabel("间距："))
+        self.tile_spacing_spin = QSpinBox()
+        self.tile_spacing_spin.setRange(0, 2000)
+        self.tile_spacing_spin.setSuffix(" px")
+        self.tile_spacing_spin.setValue(self.tile_spacing)
+        self.tile_spacing_spin.valueChanged.connect(self.on_tile_spacing_changed)
+        tile_layout.addWidget(self.tile_spacing_spin)
+        text_group_layout.addLayout(tile_layout)
+        self.update_tile_controls()
+        
         # 透明度设置
         opacity_layout = QHBoxLayout()
         opacity_layout.addWidget(QLabel("透明度："))
@@ -162,6 +400,49 @@ class WatermarkApp(QMainWindow):
         text_group.setLayout(text_group_layout)
         text_layout.addWidget(text_group)
         
+        # 图片水印（Logo）
+        logo_group = QGroupBox("图片水印")
+        logo_group_layout = QVBoxLayout()
+        
+        logo_file_layout = QHBoxLayout()
+        logo_file_layout.addWidget(QLabel("Logo文件："))
+        self.logo_input = QLineEdit(self.logo_path)
+        self.logo_input.setReadOnly(True)
+        logo_file_layout.addWidget(self.logo_input)
+        logo_browse_button = QPushButton("选择...")
+        logo_browse_button.clicked.connect(self.choose_logo)
+        logo_file_layout.addWidget(logo_browse_button)
+        logo_clear_button = QPushButton("清除")
+        logo_clear_button.clicked.connect(self.clear_logo)
+        logo_file_layout.addWidget(logo_clear_button)
+        logo_group_layout.addLayout(logo_file_layout)
+        
+        logo_options_layout = QHBoxLayout()
+        logo_options_layout.addWidget(QLabel("位置："))
+        self.logo_position_combo = QComboBox()
+        self.logo_position_combo.addItems(["左上", "右上", "左下", "右下", "中心"])
+        self.logo_position_combo.setCurrentIndex(self.logo_position_index(self.logo_position))
+        self.logo_position_combo.currentIndexChanged.connect(self.on_logo_position_changed)
+        logo_options_layout.addWidget(self.logo_position_combo)
+        logo_options_layout.addWidget(QLabel("大小："))
+        self.logo_scale_spin = QSpinBox()
+        self.logo_scale_spin.setRange(1, 100)
+        self.logo_scale_spin.setSuffix("%")
+        self.logo_scale_spin.setValue(self.logo_scale)
+        self.logo_scale_spin.valueChanged.connect(self.on_logo_scale_changed)
+        logo_options_layout.addWidget(self.logo_scale_spin)
+        logo_options_layout.addWidget(QLabel("透明度："))
+        self.logo_opacity_spin = QSpinBox()
+        self.logo_opacity_spin.setRange(0, 100)
+        self.logo_opacity_spin.setSuffix("%")
+        self.logo_opacity_spin.setValue(self.logo_opacity)
+        self.logo_opacity_spin.valueChanged.connect(self.on_logo_opacity_changed)
+        logo_options_layout.addWidget(self.logo_opacity_spin)
+        logo_group_layout.addLayout(logo_options_layout)
+        
+        logo_group.setLayout(logo_group_layout)
+        text_layout.addWidget(logo_group)
+        
         # 输出设置
         output_group = QGroupBox("输出设置")
         output_layout = QVBoxLayout()
@@ -170,12 +451,33 @@ class WatermarkApp(QMainWindow):
         format_layout = QHBoxLayout()
         format_layout.addWidget(QLabel("输出格式："))
         self.format_combo = QComboBox()
-        self.format_combo.addItems(["PNG", "JPEG"])
+        self.format_combo.addItems(watermark_core.OUTPUT_FORMATS)
         self.format_combo.setCurrentText(self.output_format)
         self.format_combo.currentTextChanged.connect(self.on_format_changed)
         format_layout.addWidget(self.format_combo)
         output_layout.addLayout(format_layout)
         
+        # 编码速度与文件体积
+        speed_layout = QHBoxLayout()
+        speed_layout.addWidget(QLabel("编码方式："))
+        self.speed_combo = QComboBox()
+        self.speed_combo.addItems(["快速", "均衡", "最小体积"])
+        self.speed_combo.setCurrentIndex(self.encoder_speed_index(self.encoder_speed))
+        self.speed_combo.currentIndexChanged.connect(self.on_encoder_speed_changed)
+        speed_layout.addWidget(self.speed_combo)
+        output_layout.addLayout(speed_layout)
+        
+        self.keep_metadata_check = QCheckBox("保留EXIF和ICC信息")
+        self.keep_metadata_check.setChecked(self.keep_metadata)
+        self.keep_metadata_check.toggled.connect(self.on_keep_metadata_changed)
+        output_layout.addWidget(self.keep_metadata_check)
+        
+        # 输出配置（多尺寸/多格式）只能通过模板或设置文件配置，这里显示当前的目标
+        self.output_profiles_label = QLabel()
+        self.output_profiles_label.setWordWrap(True)
+        self.update_output_profiles_label()
+        output_layout.addWidget(self.output_profiles_label)
+        
         # 输出文件夹
         folder_layout = QHBoxLayout()
         folder_layout.addWidget(QLabel("输出文件夹："))
@@ -191,9 +493,7 @@ class WatermarkApp(QMainWindow):
         naming_layout.addWidget(QLabel("命名规则："))
         self.naming_combo = QComboBox()
         self.naming_combo.addItems(["保留原文件名", "添加前缀", "添加后缀"])
-        self.naming_combo.setCurrentIndex({
-            "original": 0, "prefix": 1, "suffix": 2
-        }.get(self.file_naming_rule, 0))
+        self.naming_combo.setCurrentIndex(self.naming_rule_index(self.file_naming_rule))
         self.naming_combo.currentIndexChanged.connect(self.on_naming_changed)
         naming_layout.addWidget(self.naming_combo)
         output_layout.addLayout(naming_layout)
@@ -214,6 +514,54 @@ class WatermarkApp(QMainWindow):
         self.suffix_layout.addWidget(self.suffix_input)
         output_layout.addLayout(self.suffix_layout)
         
+        # 导出进程数
+        workers_layout = QHBoxLayout()
+        workers_layout.addWidget(QLabel("导出进程数："))
+        self.workers_spin = QSpinBox()
+        self.workers_spin.setRange(1, max(64, default_worker_count()))
+        self.workers_spin.setValue(self.export_workers)
+        self.workers_spin.valueChanged.connect(self.on_workers_changed)
+        workers_layout.addWidget(self.workers_spin)
+        output_layout.addLayout(workers_layout)
+        
+        # 导出内存上限：同时处理的图片估算内存之和不超过该值，超大扫描图单独处理
+        memory_layout = QHBoxLayout()
+        memory_layout.addWidget(QLabel("导出内存上限："))
+        self.memory_limit_spin = QSpinBox()
+        self.memory_limit_spin.setRange(0, 1024 * 1024)
+        self.memory_limit_spin.setSingleStep(256)
+        self.memory_limit_spin.setSuffix(" MB")
+        self.memory_limit_spin.setSpecialValueText("不限制")
+        self.memory_limit_spin.setValue(self.export_memory_limit)
+        self.memory_limit_spin.valueChanged.connect(self.on_memory_limit_changed)
+        memory_layout.addWidget(self.memory_limit_spin)
+        output_layout.addLayout(memory_layout)
+        
+        # 最大图片像素：放宽Pillow的解压炸弹保护，用于处理可信的超大扫描图
+        pixels_layout = QHBoxLayout()
+        pixels_layout.addWidget(QLabel("最大图片像素："))
+        self.max_megapixels_spin = QSpinBox()
+        self.max_megapixels_spin.setRange(0, 100000)
+        self.max_megapixels_spin.setSingleStep(100)
+        self.max_megapixels_spin.setSuffix(" 百万")
+        self.max_megapixels_spin.setSpecialValueText("默认")
+        self.max_megapixels_spin.setValue(self.max_megapixels)
+        self.max_megapixels_spin.valueChanged.connect(self.on_max_megapixels_changed)
+        pixels_layout.addWidget(self.max_megapixels_spin)
+        output_layout.addLayout(pixels_layout)
+        
+        # 增量导出
+        self.incremental_check = QCheckBox("增量导出（跳过未变化的图片）")
+        self.incremental_check.setChecked(self.incremental_export)
+        self.incremental_check.toggled.connect(self.on_incremental_changed)
+        output_layout.addWidget(self.incremental_check)
+        
+        # 记录各阶段耗时，导出后显示汇总并保存 Chrome trace
+        self.trace_check = QCheckBox("记录导出耗时")
+        self.trace_check.setChecked(self.trace_export)
+        self.trace_check.toggled.connect(self.on_trace_changed)
+        output_layout.addWidget(self.trace_check)
+        
         output_group.setLayout(output_layout)
         text_layout.addWidget(output_group)
         
@@ -246,6 +594,10 @@ class WatermarkApp(QMainWindow):
         delete_template_btn.clicked.connect(self.delete_template)
         template_buttons_layout.addWidget(delete_template_btn)
         
+        import_template_btn = QPushButton("导入模板文件")
+        import_template_btn.clicked.connect(self.import_templates)
+        template_buttons_layout.addWidget(import_template_btn)
+        
         template_group_layout.addLayout(template_buttons_layout)
         
         template_group.setLayout(template_group_layout)
@@ -315,6 +667,67 @@ class WatermarkApp(QMainWindow):
         toolbar.addAction(add_folder_action)
         toolbar.addAction(export_action)
     
+    def open_thumbnail_store(self):
+        # 缩略图磁盘缓存，无法打开时只使用内存缓存
+        try:
+            return ThumbnailStore(os.path.join(self.cache_folder, "thumbnails.db"))
+        except Exception as e:
+            print(f"无法打开缩略图缓存: {e}", file=sys.stderr)
+            return None
+    
+    def open_metadata_index(self):
+        # 拍摄日期索引，无法打开磁盘文件时只使用内存缓存
+        try:
+            return MetadataIndex(os.path.join(self.cache_folder, "metadata.db"))
+        except Exception as e:
+            print(f"无法打开日期索引: {e}", file=sys.stderr)
+            return MetadataIndex()
+    
+    def open_export_queue(self):
+        # 导出任务队列，无法打开时导出不能在重启后继续，但不影响正常导出
+        try:
+            return ExportQueue(os.path.join(self.cache_folder, "export_queue.db"))
+        except Exception as e:
+            print(f"无法打开导出任务队列: {e}", file=sys.stderr)
+            return None
+    
+    def open_template_store(self):
+        # 模板库，无法打开磁盘文件时使用内存中的模板库（本次运行保存的模板不会保留）
+        try:
+            return TemplateStore(default_store_path(self.template_folder))
+        except Exception as e:
+            print(f"无法打开模板库: {e}", file=sys.stderr)
+            return TemplateStore(":memory:")
+    
+    def sync_template_folder(self):
+        # 模板文件夹中新增或修改过的JSON模板（包括旧版本保存的模板）导入到模板库
+        imported, failures = self.template_store.sync_folder(self.template_folder)
+        if imported:
+            self.load_templates()
+        if failures:
+            names = "、".join(os.path.basename(file_path) for file_path, _ in failures)
+            self.status_bar.setText(f"无法导入 {len(failures)} 个模板文件: {names}")
+    
+    def check_unfinished_export(self):
+        if self.export_queue is None:
+            return
+        unfinished = self.export_queue.unfinished_batch()
+        if unfinished is None:
+            return
+        batch_id, settings, remaining, total = unfinished
+        if remaining == 0:
+            self.export_queue.finish_batch(batch_id)
+            return
+        reply = QMessageBox.question(
+            self, "继续导出",
+            f"上次导出未完成（已处理 {total - remaining}/{total} 张），是否继续导出剩余的 {remaining} 张图片？",
+            QMessageBox.Yes | QMessageBox.No
+        )
+        if reply == QMessageBox.Yes:
+            self.start_export(self.export_queue.pending_files(batch_id), settings, batch_id)
+        else:
+            self.export_queue.finish_batch(batch_id)
+    
     def add_images(self):
         options = QFileDialog.Options()
         file_paths, _ = QFileDialog.getOpenFileNames(
@@ -333,176 +746,253 @@ class WatermarkApp(QMainWindow):
         )
         
         if folder:
-            # 获取文件夹中的所有图片文件
-            image_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff']
-            file_paths = []
-            
-            for root, _, files in os.walk(folder):
-                for file in files:
-                    if any(file.lower().endswith(ext) for ext in image_extensions):
-                        file_paths.append(os.path.join(root, file))
-            
-            if file_paths:
-                self.add_files_to_list(file_paths)
+            self.scan_folders([folder])
+    
+    def scan_folders(self, folders):
+        # 在后台扫描文件夹中的所有图片文件，扫描过程中逐步添加到列表
+        scan_thread = ScanThread(folders, ignore_paths=[self.output_folder], parent=self)
+        scan_thread.batch_found.connect(self.on_scan_batch)
+        scan_thread.scan_finished.connect(lambda found, cancelled: self.on_scan_finished(scan_thread, found, cancelled))
+        self.scan_threads.append(scan_thread)
+        self.status_bar.setText("正在扫描文件夹...")
+        scan_thread.start()
+    
+    def on_scan_batch(self, file_paths):
+        self.add_files_to_list(file_paths)
+        self.status_bar.setText(f"正在扫描文件夹... 已添加 {len(self.image_paths)} 张图片")
+    
+    def on_scan_finished(self, scan_thread, found, cancelled):
+        if scan_thread in self.scan_threads:
+            self.scan_threads.remove(scan_thread)
+        if not cancelled:
+            self.status_bar.setText(f"扫描完成，找到 {found} 张图片，列表中共 {len(self.image_paths)} 张")
     
     def add_files_to_list(self, file_paths):
-        for file_path in file_paths:
-            if file_path not in self.image_paths:
-                self.image_paths.append(file_path)
-                
-                # 创建列表项
-                item = QListWidgetItem()
-                
-                # 创建缩略图
-                pixmap = QPixmap(file_path)
-                if not pixmap.isNull():
-                    scaled_pixmap = pixmap.scaled(120, 120, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-                    item.setIcon(QIcon(scaled_pixmap))
-                
-                # 设置文件名
-                file_name = os.path.basename(file_path)
-                item.setText(file_name)
-                item.setTextAlignment(Qt.AlignHCenter | Qt.AlignBottom)
-                
-                # 将项添加到列表
-                self.image_list.addItem(item)
+        # 只登记路径，缩略图由列表模型按需在后台生成
+        self.image_model.add_paths(file_paths)
         
         # 如果是第一次添加图片，自动选择第一张
         if len(self.image_paths) > 0 and self.current_index == -1:
-            self.image_list.setCurrentRow(0)
-            self.on_image_selected(self.image_list.item(0))
-    
-    def on_image_selected(self, item):
-        if item:
-            index = self.image_list.row(item)
-            if 0 <= index < len(self.image_paths):
-                self.current_index = index
+            first_index = self.image_model.index(0)
+            self.image_list.setCurrentIndex(first_index)
+            self.on_image_selected(first_index)
+    
+    def on_image_selected(self, index):
+        if index.isValid():
+            row = index.row()
+            if 0 <= row < len(self.image_paths):
+                self.current_index = row
+                self.preview_full_size = None
                 self.update_preview()
     
+    def schedule_preview(self):
+        if not self.preview_timer.isActive():
+            self.preview_timer.start()
+    
     def update_preview(self):
         if 0 <= self.current_index < len(self.image_paths):
-            file_path = self.image_paths[self.current_index]
-            
-            try:
-                # 打开图片并添加水印进行预览
-                image = Image.open(file_path)
-                preview_image = self.add_watermark_to_image(image, preview=True)
-                
-                # 转换为QPixmap显示
-                q_image = self.pil_to_qimage(preview_image)
-                pixmap = QPixmap.fromImage(q_image)
-                
-                # 调整大小以适应预览窗口
-                max_size = self.preview_label.size()
-                scaled_pixmap = pixmap.scaled(max_size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-                self.preview_label.setPixmap(scaled_pixmap)
-                
-                # 更新状态栏
-                self.status_bar.setText(f"预览: {os.path.basename(file_path)}")
-                
-            except Exception as e:
-                self.status_bar.setText(f"错误: 无法预览图片 - {str(e)}")
+            # 每次请求递增代数，后台返回的旧结果不再显示
+            self.preview_generation += 1
+            label_size = self.preview_label.size()
+            # Logo图片不可用时预览跳过Logo，并在状态栏中提示
+            settings, self.logo_warning = watermark_core.check_logo(self.get_render_settings())
+            task = PreviewTask(
+                self.preview_generation, lambda: self.preview_generation,
+                self.image_paths[self.current_index], (label_size.width(), label_size.height()),
+                settings, self.preview_cache, self.preview_signals, self.metadata_index
+            )
+            self.preview_metrics.record_submit()
+            self.preview_pool.start(task)
     
-    def add_watermark_to_image(self, image, preview=False):
-        # 创建图片副本
-        watermarked_image = image.copy()
-        
-        # 确保图像是RGBA模式以便支持透明度
-        if watermarked_image.mode != 'RGBA':
-            watermarked_image = watermarked_image.convert('RGBA')
-        
-        # 创建绘图对象
-        draw = ImageDraw.Draw(watermarked_image, 'RGBA')
-        
-        # 计算字体大小
-        font_size = max(12, min(watermarked_image.width, watermarked_image.height) // 20)
-        
-        try:
-            # 尝试加载系统字体
-            font = ImageFont.truetype("simhei.ttf", font_size)
-        except:
-            # 如果加载失败，使用默认字体
-            font = ImageFont.load_default()
-        
-        # 计算水印位置（保持原代码不变）
-        if self.watermark_position.isNull() or (self.watermark_position.x() == 0 and self.watermark_position.y() == 0):
-            # 默认位置：右下角
-            # 获取文本尺寸（使用textbbox替代textsize）
-            bbox = draw.textbbox((0, 0), self.watermark_text, font=font)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
-            # 确保文本不会超出边界
-            position = (watermarked_image.width - text_width - 20, watermarked_image.height - text_height - 20)
-        else:
-            # 从预设位置获取坐标
-            x, y = self.watermark_position.x(), self.watermark_position.y()
-            # 获取文本尺寸（使用textbbox替代textsize）
-            bbox = draw.textbbox((0, 0), self.watermark_text, font=font)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
-            
-            # 检查并纠正文本是否会超出边界
-            # 对于右侧位置
-            if x > watermarked_image.width - text_width - 20:
-                x = watermarked_image.width - text_width - 20
-            # 对于底部位置
-            if y > watermarked_image.height - text_height - 20:
-                y = watermarked_image.height - text_height - 20
-            # 确保位置不为负数
-            x = max(20, x)
-            y = max(20, y)
-            
-            position = (x, y)
-        
-        # 绘制文本水印
-        # 透明度计算公式
-        opacity = int(255 * (1-self.text_opacity / 100))  # 正确的计算公式
-        draw.text(position, self.watermark_text, font=font, fill=(255, 0, 0, opacity))
-        
-        # 只有在需要时才转换为RGB模式（JPEG格式）
-        if (self.output_format == 'JPEG' or (preview and self.output_format == 'JPEG')):
-            background = Image.new('RGB', watermarked_image.size, (255, 255, 255))
-            background.paste(watermarked_image, mask=watermarked_image.split()[3])
-            watermarked_image = background
+    def on_preview_rendered(self, generation, q_image, full_size, latency):
+        stale = generation != self.preview_generation
+        self.preview_metrics.record_finish(latency, dropped=stale)
+        if stale or not (0 <= self.current_index < len(self.image_paths)):
+            return
         
-        return watermarked_image
+        # 转换为QPixmap显示
+        pixmap = QPixmap.fromImage(q_image)
+        self.preview_label.setPixmap(pixmap)
+        self.preview_full_size = full_size
+        self.preview_display_size = (pixmap.width(), pixmap.height())
+        
+        # 更新状态栏
+        stats = self.preview_metrics.stats()
+        self.status_bar.setText(
+            f"预览: {os.path.basename(self.image_paths[self.current_index])}"
+            f"（渲染 {stats['last_ms']} ms，队列 {stats['queue_depth']}）"
+            + (f"；{self.logo_warning}" if self.logo_warning else "")
+        )
+    
+    def on_preview_failed(self, generation, error, latency):
+        stale = generation != self.preview_generation
+        self.preview_metrics.record_finish(latency, dropped=stale)
+        if not stale:
+            self.preview_full_size = None
+            self.status_bar.setText(f"错误: 无法预览图片 - {error}")
+    
+    def preview_pos_to_image(self, pos):
+        # 将预览区域中的鼠标位置换算为原图坐标
+        if self.preview_full_size is None:
+            return pos
+        x, y = map_to_image(
+            (pos.x(), pos.y()),
+            (self.preview_label.width(), self.preview_label.height()),
+            self.preview_display_size,
+            self.preview_full_size
+        )
+        return QPoint(x, y)
+    
+    def get_render_settings(self):
+        # 导出和渲染所需的设置，使用可序列化的字典以便传递给子进程
+        return {
+            "watermark_text": self.watermark_text,
+            "text_opacity": self.text_opacity,
+            "watermark_position": {
+                "x": self.watermark_position.x(),
+                "y": self.watermark_position.y()
+            },
+            "output_format": self.output_format,
+            "output_folder": self.output_folder,
+            "file_naming_rule": self.file_naming_rule,
+            "custom_prefix": self.custom_prefix,
+            "custom_suffix": self.custom_suffix,
+            "watermark_mode": self.watermark_mode,
+            "date_format": self.date_format,
+            "date_fallback": self.date_fallback,
+            "watermark_layout": self.watermark_layout,
+            "tile_angle": self.tile_angle,
+            "tile_spacing": self.tile_spacing,
+            "logo_path": self.logo_path,
+            "logo_scale": self.logo_scale,
+            "logo_opacity": self.logo_opacity,
+            "logo_position": self.logo_position,
+            "encoder_speed": self.encoder_speed,
+            "encoder_profiles": self.encoder_profiles,
+            "keep_metadata": self.keep_metadata,
+            "output_profiles": self.output_profiles
+        }
+    
+    def add_watermark_to_image(self, image):
+        return watermark_core.add_watermark_to_image(image, self.get_render_settings())
     
     def pil_to_qimage(self, pil_image):
-        # 将PIL图像转换为QImage
-        if pil_image.mode == 'RGB':
-            # 对于RGB模式，我们需要将数据转换为RGBA格式
-            # 创建一个临时图像
-            temp_image = Image.new('RGBA', pil_image.size, (255, 255, 255, 255))
-            temp_image.paste(pil_image, mask=None)
-            # 将图像数据转换为字节
-            data = temp_image.tobytes('raw', 'RGBA')
-            # 创建QImage
-            q_image = QImage(data, temp_image.size[0], temp_image.size[1], QImage.Format_RGBA8888)
-        elif pil_image.mode == 'RGBA':
-            # 对于RGBA模式，直接使用RGBA8888格式
-            data = pil_image.tobytes('raw', 'RGBA')
-            q_image = QImage(data, pil_image.size[0], pil_image.size[1], QImage.Format_RGBA8888)
-        else:
-            # 对于其他模式，转换为RGB模式
-            rgb_image = pil_image.convert('RGB')
-            data = rgb_image.tobytes('raw', 'RGB')
-            q_image = QImage(data, rgb_image.size[0], rgb_image.size[1], QImage.Format_RGB888)
-            q_image = q_image.rgbSwapped()  # Qt的RGB顺序与PIL不同
-        
-        return q_image
+        return pil_to_qimage(pil_image)
     
     def on_text_changed(self, text):
         self.watermark_text = text
-        self.update_preview()
+        self.schedule_preview()
+    
+    def watermark_mode_index(self, mode):
+        if mode in watermark_core.WATERMARK_MODES:
+            return watermark_core.WATERMARK_MODES.index(mode)
+        return 0
+    
+    def on_mode_changed(self, index):
+        if 0 <= index < len(watermark_core.WATERMARK_MODES):
+            self.watermark_mode = watermark_core.WATERMARK_MODES[index]
+            self.text_input.setEnabled(self.watermark_mode == "text")
+            self.schedule_preview()
+    
+    def on_date_format_changed(self, text):
+        self.date_format = text
+        self.schedule_preview()
+    
+    def on_date_fallback_changed(self, checked):
+        self.date_fallback = "mtime" if checked else "none"
+        self.schedule_preview()
+    
+    def watermark_layout_index(self, layout):
+        if layout in watermark_core.WATERMARK_LAYOUTS:
+            return watermark_core.WATERMARK_LAYOUTS.index(layout)
+        return 0
+    
+    def update_tile_controls(self):
+        tiled = self.watermark_layout == "tiled"
+        self.tile_angle_spin.setEnabled(tiled)
+        self.tile_spacing_spin.setEnabled(tiled)
+    
+    def on_layout_changed(self, index):
+        if 0 <= index < len(watermark_core.WATERMARK_LAYOUTS):
+            self.watermark_layout = watermark_core.WATERMARK_LAYOUTS[index]
+            self.update_tile_controls()
+            self.schedule_preview()
+    
+    def on_tile_angle_changed(self, value):
+        self.tile_angle = value
+        self.schedule_preview()
+    
+    def on_tile_spacing_changed(self, value):
+        self.tile_spacing = value
+        self.schedule_preview()
+    
+    def choose_logo(self):
+        options = QFileDialog.Options()
+        logo_path, _ = QFileDialog.getOpenFileName(
+            self, "选择Logo", "",
+            "图片文件 (*.png *.jpg *.jpeg *.bmp *.tiff);;所有文件 (*)",
+            options=options
+        )
+        if logo_path:
+            self.logo_path = os.path.abspath(logo_path)
+            self.logo_input.setText(self.logo_path)
+            self.schedule_preview()
+    
+    def clear_logo(self):
+        self.logo_path = ""
+        self.logo_input.setText("")
+        self.schedule_preview()
+    
+    def logo_position_index(self, position):
+        if position in watermark_core.LOGO_POSITIONS:
+            return watermark_core.LOGO_POSITIONS.index(position)
+        return 0
+    
+    def on_logo_position_changed(self, index):
+        if 0 <= index < len(watermark_core.LOGO_POSITIONS):
+            self.logo_position = watermark_core.LOGO_POSITIONS[index]
+            self.schedule_preview()
+    
+    def on_logo_scale_changed(self, value):
+        self.logo_scale = value
+        self.schedule_preview()
+    
+    def on_logo_opacity_changed(self, value):
+        self.logo_opacity = value
+        self.schedule_preview()
     
     def on_opacity_changed(self, value):
         self.text_opacity = value
         self.opacity_label.setText(f"{value}%")
-        self.update_preview()
+        self.schedule_preview()
     
     def on_format_changed(self, text):
         self.output_format = text
     
+    def encoder_speed_index(self, speed):
+        if speed in encoders.ENCODER_SPEEDS:
+            return encoders.ENCODER_SPEEDS.index(speed)
+        return encoders.ENCODER_SPEEDS.index("balanced")
+    
+    def on_encoder_speed_changed(self, index):
+        if 0 <= index < len(encoders.ENCODER_SPEEDS):
+            self.encoder_speed = encoders.ENCODER_SPEEDS[index]
+    
+    def on_keep_metadata_changed(self, checked):
+        self.keep_metadata = checked
+    
+    def update_output_profiles_label(self):
+        if not self.output_profiles:
+            self.output_profiles_label.setText("输出配置：单一输出")
+            self.output_profiles_label.setToolTip("")
+            return
+        targets = []
+        for profile in self.output_profiles:
+            size = f"{profile['max_size']}px" if profile.get("max_size") else "原尺寸"
+            targets.append(f"{profile.get('name') or '输出文件夹'}（{size} {profile.get('output_format', self.output_format)}）")
+        self.output_profiles_label.setText(f"输出配置：{len(targets)} 个目标，每张图片只解码一次")
+        self.output_profiles_label.setToolTip("\n".join(targets))
+    
     def browse_output_folder(self):
         options = QFileDialog.Options()
         folder = QFileDialog.getExistingDirectory(
@@ -513,19 +1003,36 @@ class WatermarkApp(QMainWindow):
             self.output_folder = folder
             self.folder_path.setText(folder)
     
+    def naming_rule_index(self, rule):
+        if rule in watermark_core.NAMING_RULES:
+            return watermark_core.NAMING_RULES.index(rule)
+        return 0
+    
     def on_naming_changed(self, index):
-        if index == 0:
-            self.file_naming_rule = "original"
-            self.prefix_layout.setEnabled(False)
-            self.suffix_layout.setEnabled(False)
-        elif index == 1:
-            self.file_naming_rule = "prefix"
-            self.prefix_layout.setEnabled(True)
-            self.suffix_layout.setEnabled(False)
-        elif index == 2:
-            self.file_naming_rule = "suffix"
-            self.prefix_layout.setEnabled(False)
-            self.suffix_layout.setEnabled(True)
+        if 0 <= index < len(watermark_core.NAMING_RULES):
+            self.file_naming_rule = watermark_core.NAMING_RULES[index]
+            self.prefix_layout.setEnabled(self.file_naming_rule == "prefix")
+            self.suffix_layout.setEnabled(self.file_naming_rule == "suffix")
+    
+    def on_workers_changed(self, value):
+        self.export_workers = value
+    
+    def on_memory_limit_changed(self, value):
+        self.export_memory_limit = value
+    
+    def on_max_megapixels_changed(self, value):
+        self.max_megapixels = value
+        # 预览也在本进程中解码图片
+        watermark_core.configure_image_limits(self.max_image_pixels())
+    
+    def max_image_pixels(self):
+        return self.max_megapixels * 1000000 if self.max_megapixels else None
+    
+    def on_incremental_changed(self, checked):
+        self.incremental_export = checked
+    
+    def on_trace_changed(self, checked):
+        self.trace_export = checked
     
     def on_prefix_changed(self, text):
         self.custom_prefix = text
@@ -537,27 +1044,28 @@ class WatermarkApp(QMainWindow):
         if self.current_index != -1 and event.button() == Qt.LeftButton:
             self.dragging = True
             self.drag_start_pos = event.pos()
-            self.watermark_position = event.pos()
-            self.update_preview()
+            self.watermark_position = self.preview_pos_to_image(event.pos())
+            self.schedule_preview()
     
     def on_preview_drag(self, event):
         if self.dragging and self.current_index != -1:
-            self.watermark_position = event.pos()
-            self.update_preview()
+            self.watermark_position = self.preview_pos_to_image(event.pos())
+            self.schedule_preview()
     
     def on_preview_release(self, event):
         if self.dragging and self.current_index != -1:
             self.dragging = False
-            self.watermark_position = event.pos()
-            self.update_preview()
+            self.watermark_position = self.preview_pos_to_image(event.pos())
+            self.schedule_preview()
     
     def set_preset_position(self, position):
         if self.current_index != -1:
-            file_path = self.image_paths[self.current_index]
-            image = Image.open(file_path)
-            
-            # 直接使用原始图像尺寸计算水印位置
-            width, height = image.width, image.height
+            # 直接使用原始图像尺寸计算水印位置（只读取文件头）
+            if self.preview_full_size is not None:
+                width, height = self.preview_full_size
+            else:
+                with Image.open(self.image_paths[self.current_index]) as image:
+                    width, height = image.width, image.height
             
             # 根据预设位置计算水印位置
             if position == "左上":
@@ -580,51 +1088,83 @@ class WatermarkApp(QMainWindow):
             QMessageBox.warning(self, "警告", "没有图片可导出")
             return
         
-        # 确保输出文件夹存在
-        os.makedirs(self.output_folder, exist_ok=True)
+        if self.export_thread is not None and self.export_thread.isRunning():
+            QMessageBox.warning(self, "警告", "正在导出，请稍候")
+            return
         
-        # 导出所有图片
-        for i, file_path in enumerate(self.image_paths):
-            try:
-                # 更新状态栏
-                self.status_bar.setText(f"正在导出图片 {i+1}/{len(self.image_paths)}: {os.path.basename(file_path)}")
-                QApplication.processEvents()  # 刷新界面
-                
-                # 打开图片
-                image = Image.open(file_path)
-                
-                # 添加水印
-                watermarked_image = self.add_watermark_to_image(image)
-                
-                # 确定输出文件名
-                file_name = os.path.basename(file_path)
-                base_name, ext = os.path.splitext(file_name)
-                
-                if self.file_naming_rule == "original":
-                    output_name = f"{base_name}.{self.output_format.lower()}"
-                elif self.file_naming_rule == "prefix":
-                    output_name = f"{self.custom_prefix}{base_name}.{self.output_format.lower()}"
-                elif self.file_naming_rule == "suffix":
-                    output_name = f"{base_name}{self.custom_suffix}.{self.output_format.lower()}"
-                
-                # 保存图片
-                output_path = os.path.join(self.output_folder, output_name)
-                
-                # 根据格式设置保存参数
-                if self.output_format == "PNG":
-                    watermarked_image.save(output_path, format="PNG")
-                else:
-                    # 对于JPEG，确保图片是RGB模式
-                    if watermarked_image.mode != "RGB":
-                        watermarked_image = watermarked_image.convert("RGB")
-                    watermarked_image.save(output_path, format="JPEG", quality=95)
-                
-            except Exception as e:
-                QMessageBox.warning(self, "错误", f"无法导出图片 {os.path.basename(file_path)}: {str(e)}")
+        self.start_export(self.image_paths, self.get_render_settings())
+    
+    def start_export(self, file_paths, settings, batch_id=None):
+        # 在后台进程池中导出图片，每张图片的状态记录在任务队列中
+        try:
+            watermark_core.output_targets(settings)
+        except ValueError as e:
+            QMessageBox.warning(self, "错误", str(e))
+            return
+        self.export_thread = ExportThread(
+            file_paths, settings, self.export_workers, self.incremental_export,
+            self.metadata_index, ExportTrace() if self.trace_export else None,
+            self.export_memory_limit * 1024 * 1024 if self.export_memory_limit else None,
+            self.export_queue, batch_id, self.max_image_pixels(), self
+        )
+        self.export_thread.progress.connect(self.on_export_progress)
+        self.export_thread.export_finished.connect(self.on_export_finished)
+        self.export_button.setEnabled(False)
+        self.cancel_export_button.setEnabled(True)
+        self.status_bar.setText(
+            f"正在导出 {len(file_paths)} 张图片..." + "".join(f"；{warning}" for warning in self.export_thread.engine.warnings)
+        )
+        self.export_thread.start()
+    
+    def cancel_export(self):
+        if self.export_thread is not None and self.export_thread.isRunning():
+            self.export_thread.cancel()
+            self.cancel_export_button.setEnabled(False)
+            self.status_bar.setText("正在取消导出...")
+    
+    def on_export_progress(self, done, total, file_path, error):
+        # 更新状态栏
+        if error:
+            self.status_bar.setText(f"无法导出图片 {os.path.basename(file_path)}: {error}")
+        else:
+            self.status_bar.setText(f"正在导出图片 {done}/{total}: {os.path.basename(file_path)}")
+    
+    def on_export_finished(self, succeeded, total, failures, cancelled):
+        self.export_button.setEnabled(True)
+        self.cancel_export_button.setEnabled(False)
+        
+        if cancelled:
+            self.status_bar.setText(f"导出已取消，已导出 {succeeded} 张图片")
+            return
         
         # 导出完成
-        self.status_bar.setText(f"导出完成！共 {len(self.image_paths)} 张图片，保存至: {self.output_folder}")
-        QMessageBox.information(self, "完成", f"成功导出 {len(self.image_paths)} 张图片")
+        skipped = self.export_thread.engine.skipped
+        skipped_text = f"，跳过未变化的 {skipped} 张" if skipped else ""
+        output_folder = self.export_thread.engine.settings["output_folder"]
+        self.status_bar.setText(f"导出完成！共 {succeeded} 张图片{skipped_text}，保存至: {output_folder}")
+        QMessageBox.information(self, "完成", f"成功导出 {succeeded} 张图片")
+        if failures:
+            self.show_failure_report(failures)
+        
+        trace = self.export_thread.engine.trace
+        if trace is not None:
+            trace_path = os.path.join(self.cache_folder, "export_trace.json")
+            try:
+                os.makedirs(self.cache_folder, exist_ok=True)
+                trace.save(trace_path)
+                saved_text = f"\n\n详细记录已保存至: {trace_path}"
+            except OSError:
+                saved_text = ""
+            QMessageBox.information(self, "导出耗时", trace.format_summary() + saved_text)
+    
+    def show_failure_report(self, failures):
+        # 非模态的失败报告，不阻塞界面和后续导出
+        report = QMessageBox(QMessageBox.Warning, "导出失败报告", f"{len(failures)} 张图片导出失败", QMessageBox.Close, self)
+        report.setDetailedText("\n".join(f"{path}: {error}" for path, error in failures))
+        report.setModal(False)
+        report.setAttribute(Qt.WA_DeleteOnClose)
+        report.show()
+        self.failure_report = report
     
     def dragEnterEvent(self, event):
         if event.mimeData().hasUrls():
@@ -635,44 +1175,37 @@ class WatermarkApp(QMainWindow):
         
         # 处理拖放的文件和文件夹
         file_paths = []
+        folders = []
         for file in files:
             if os.path.isdir(file):
-                # 处理文件夹
-                image_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff']
-                for root, _, files_in_dir in os.walk(file):
-                    for file_in_dir in files_in_dir:
-                        if any(file_in_dir.lower().endswith(ext) for ext in image_extensions):
-                            file_paths.append(os.path.join(root, file_in_dir))
+                # 文件夹在后台扫描
+                folders.append(file)
             elif os.path.isfile(file):
                 # 处理文件
                 file_paths.append(file)
         
         if file_paths:
             self.add_files_to_list(file_paths)
+        if folders:
+            self.scan_folders(folders)
     
     def save_template(self):
         template_name, ok = QInputDialog.getText(self, "保存模板", "请输入模板名称：")
         if ok and template_name:
             # 保存当前设置为模板
-            template = {
-                "watermark_text": self.watermark_text,
-                "text_opacity": self.text_opacity,
-                "output_format": self.output_format,
-                "file_naming_rule": self.file_naming_rule,
-                "custom_prefix": self.custom_prefix,
-                "custom_suffix": self.custom_suffix
-            }
+            template = watermark_core.template_from_settings(self.get_render_settings())
             
-            # 保存到模板字典
-            self.templates[template_name] = template
-            
-            # 保存到文件
-            template_file = os.path.join(self.template_folder, f"{template_name}.json")
-            with open(template_file, 'w', encoding='utf-8') as f:
-                json.dump(template, f, ensure_ascii=False, indent=4)
+            # 保存到模板库，只写入这一个模板
+            try:
+                self.template_store.put(template_name, template)
+            except Exception as e:
+                QMessageBox.warning(self, "错误", f"无法保存模板 '{template_name}': {str(e)}")
+                return
             
-            # 更新模板列表
-            self.load_templates()
+            # 新模板插入列表，不重新读取整个模板库
+            if not self.template_list.findItems(template_name, Qt.MatchExactly):
+                self.template_list.addItem(template_name)
+                self.template_list.sortItems()
             
             QMessageBox.information(self, "成功", f"模板 '{template_name}' 已保存")
     
@@ -681,13 +1214,14 @@ class WatermarkApp(QMainWindow):
         if current_item:
             template_name = current_item.text()
             
-            # 从文件加载模板
-            template_file = os.path.join(self.template_folder, f"{template_name}.json")
-            if os.path.exists(template_file):
+            # 选中时才从模板库读取模板内容
+            try:
+                template = self.template_store.get(template_name)
+            except Exception as e:
+                QMessageBox.warning(self, "错误", f"无法加载模板 '{template_name}': {str(e)}")
+                return
+            if template is not None:
                 try:
-                    with open(template_file, 'r', encoding='utf-8') as f:
-                        template = json.load(f)
-                    
                     # 应用模板设置
                     if "watermark_text" in template:
                         self.watermark_text = template["watermark_text"]
@@ -704,9 +1238,7 @@ class WatermarkApp(QMainWindow):
                     
                     if "file_naming_rule" in template:
                         self.file_naming_rule = template["file_naming_rule"]
-                        self.naming_combo.setCurrentIndex({
-                            "original": 0, "prefix": 1, "suffix": 2
-                        }.get(self.file_naming_rule, 0))
+                        self.naming_combo.setCurrentIndex(self.naming_rule_index(self.file_naming_rule))
                     
                     if "custom_prefix" in template:
                         self.custom_prefix = template["custom_prefix"]
@@ -716,12 +1248,70 @@ class WatermarkApp(QMainWindow):
                         self.custom_suffix = template["custom_suffix"]
                         self.suffix_input.setText(self.custom_suffix)
                     
+                    if "watermark_mode" in template:
+                        self.watermark_mode = template["watermark_mode"]
+                        self.mode_combo.setCurrentIndex(self.watermark_mode_index(self.watermark_mode))
+                    
+                    if "date_format" in template:
+                        self.date_format = template["date_format"]
+                        self.date_format_input.setText(self.date_format)
+                    
+                    if "date_fallback" in template:
+                        self.date_fallback = template["date_fallback"]
+                        self.date_fallback_check.setChecked(self.date_fallback == "mtime")
+                    
+                    if "watermark_layout" in template:
+                        self.watermark_layout = template["watermark_layout"]
+                        self.layout_combo.setCurrentIndex(self.watermark_layout_index(self.watermark_layout))
+                    
+                    if "tile_angle" in template:
+                        self.tile_angle = template["tile_angle"]
+                        self.tile_angle_spin.setValue(self.tile_angle)
+                    
+                    if "tile_spacing" in template:
+                        self.tile_spacing = template["tile_spacing"]
+                        self.tile_spacing_spin.setValue(self.tile_spacing)
+                    
+                    if "logo_path" in template:
+                        self.logo_path = template["logo_path"]
+                        self.logo_input.setText(self.logo_path)
+                    
+                    if "logo_scale" in template:
+                        self.logo_scale = template["logo_scale"]
+                        self.logo_scale_spin.setValue(self.logo_scale)
+                    
+                    if "logo_opacity" in template:
+                        self.logo_opacity = template["logo_opacity"]
+                        self.logo_opacity_spin.setValue(self.logo_opacity)
+                    
+                    if "logo_position" in template:
+                        self.logo_position = template["logo_position"]
+                        self.logo_position_combo.setCurrentIndex(self.logo_position_index(self.logo_position))
+                    
+                    if "encoder_speed" in template:
+                        self.encoder_speed = template["encoder_speed"]
+                        self.speed_combo.setCurrentIndex(self.encoder_speed_index(self.encoder_speed))
+                    
+                    if "encoder_profiles" in template:
+                        self.encoder_profiles = template["encoder_profiles"]
+                    
+                    if "keep_metadata" in template:
+                        self.keep_metadata = template["keep_metadata"]
+                        self.keep_metadata_check.setChecked(self.keep_metadata)
+                    
+                    if "output_profiles" in template:
+                        self.output_profiles = template["output_profiles"]
+                        self.update_output_profiles_label()
+                    
                     # 更新预览
                     self.update_preview()
                     
                     QMessageBox.information(self, "成功", f"已加载模板 '{template_name}'")
                 except Exception as e:
                     QMessageBox.warning(self, "错误", f"无法加载模板 '{template_name}': {str(e)}")
+            else:
+                QMessageBox.warning(self, "错误", f"模板 '{template_name}' 不存在")
+                self.load_templates()
     
     def delete_template(self):
         current_item = self.template_list.currentItem()
@@ -735,59 +1325,42 @@ class WatermarkApp(QMainWindow):
             )
             
             if reply == QMessageBox.Yes:
-                # 删除文件
-                template_file = os.path.join(self.template_folder, f"{template_name}.json")
-                if os.path.exists(template_file):
-                    try:
-                        os.remove(template_file)
-                        # 从字典中删除
-                        if template_name in self.templates:
-                            del self.templates[template_name]
-                        # 更新列表
-                        self.load_templates()
-                        QMessageBox.information(self, "成功", f"模板 '{template_name}' 已删除")
-                    except Exception as e:
-                        QMessageBox.warning(self, "错误", f"无法删除模板 '{template_name}': {str(e)}")
+                try:
+                    self.template_store.delete(template_name)
+                    # 只从列表中移除这一项
+                    self.template_list.takeItem(self.template_list.row(current_item))
+                    QMessageBox.information(self, "成功", f"模板 '{template_name}' 已删除")
+                except Exception as e:
+                    QMessageBox.warning(self, "错误", f"无法删除模板 '{template_name}': {str(e)}")
+    
+    def import_templates(self):
+        file_paths, _ = QFileDialog.getOpenFileNames(self, "导入模板", self.template_folder, "模板文件 (*.json)")
+        if not file_paths:
+            return
+        imported, failures = self.template_store.import_files(file_paths)
+        self.load_templates()
+        if failures:
+            details = "\n".join(f"{os.path.basename(file_path)}: {error}" for file_path, error in failures)
+            QMessageBox.warning(self, "导入模板", f"已导入 {imported} 个模板，{len(failures)} 个文件无法导入：\n{details}")
+        else:
+            QMessageBox.information(self, "导入模板", f"已导入 {imported} 个模板")
     
     def load_templates(self):
-        # 清空列表
+        # 只读取模板名称，模板内容在加载时才读取
         self.template_list.clear()
-        
-        # 重新加载模板
-        self.templates = {}
-        if os.path.exists(self.template_folder):
-            for file in os.listdir(self.template_folder):
-                if file.endswith(".json"):
-                    template_name = os.path.splitext(file)[0]
-                    self.template_list.addItem(template_name)
-                    
-                    # 加载模板内容
-                    try:
-                        with open(os.path.join(self.template_folder, file), 'r', encoding='utf-8') as f:
-                            self.templates[template_name] = json.load(f)
-                    except:
-                        pass  # 忽略无法加载的模板
+        self.template_list.addItems(self.template_store.names())
     
     def save_settings(self):
         try:
             # 保存当前设置
-            settings = {
-                "watermark_text": self.watermark_text,
-                "text_opacity": self.text_opacity,
-                "watermark_position": {
-                    "x": self.watermark_position.x(),
-                    "y": self.watermark_position.y()
-                },
-                "output_format": self.output_format,
-                "output_folder": self.output_folder,
-                "file_naming_rule": self.file_naming_rule,
-                "custom_prefix": self.custom_prefix,
-                "custom_suffix": self.custom_suffix
-            }
+            settings = self.get_render_settings()
+            settings["export_workers"] = self.export_workers
+            settings["export_memory_limit"] = self.export_memory_limit
+            settings["max_megapixels"] = self.max_megapixels
+            settings["incremental_export"] = self.incremental_export
             
-            settings_file = os.path.join(os.getcwd(), "watermark_settings.json")
-            with open(settings_file, 'w', encoding='utf-8') as f:
-                json.dump(settings, f, ensure_ascii=False, indent=4)
+            settings_file = os.path.join(os.getcwd(), watermark_core.SETTINGS_FILE_NAME)
+            watermark_core.write_json_file(settings, settings_file)
             
             QMessageBox.information(self, "成功", "设置已保存")
         except Exception as e:
@@ -795,10 +1368,9 @@ class WatermarkApp(QMainWindow):
     
     def load_settings(self):
         try:
-            settings_file = os.path.join(os.getcwd(), "watermark_settings.json")
+            settings_file = os.path.join(os.getcwd(), watermark_core.SETTINGS_FILE_NAME)
             if os.path.exists(settings_file):
-                with open(settings_file, 'r', encoding='utf-8') as f:
-                    settings = json.load(f)
+                settings = watermark_core.read_json_file(settings_file)
                 
                 # 加载设置
                 if "watermark_text" in settings:
@@ -825,6 +1397,60 @@ class WatermarkApp(QMainWindow):
                 
                 if "custom_suffix" in settings:
                     self.custom_suffix = settings["custom_suffix"]
+                
+                if "watermark_mode" in settings:
+                    self.watermark_mode = settings["watermark_mode"]
+                
+                if "date_format" in settings:
+                    self.date_format = settings["date_format"]
+                
+                if "date_fallback" in settings:
+                    self.date_fallback = settings["date_fallback"]
+                
+                if "watermark_layout" in settings:
+                    self.watermark_layout = settings["watermark_layout"]
+                
+                if "tile_angle" in settings:
+                    self.tile_angle = settings["tile_angle"]
+                
+                if "tile_spacing" in settings:
+                    self.tile_spacing = settings["tile_spacing"]
+                
+                if "logo_path" in settings:
+                    self.logo_path = settings["logo_path"]
+                
+                if "logo_scale" in settings:
+                    self.logo_scale = settings["logo_scale"]
+                
+                if "logo_opacity" in settings:
+                    self.logo_opacity = settings["logo_opacity"]
+                
+                if "logo_position" in settings:
+                    self.logo_position = settings["logo_position"]
+                
+                if "encoder_speed" in settings:
+                    self.encoder_speed = settings["encoder_speed"]
+                
+                if "encoder_profiles" in settings:
+                    self.encoder_profiles = settings["encoder_profiles"]
+                
+                if "keep_metadata" in settings:
+                    self.keep_metadata = settings["keep_metadata"]
+                
+                if "output_profiles" in settings:
+                    self.output_profiles = settings["output_profiles"]
+                
+                if "export_workers" in settings:
+                    self.export_workers = settings["export_workers"]
+                
+                if "export_memory_limit" in settings:
+                    self.export_memory_limit = settings["export_memory_limit"]
+                
+                if "max_megapixels" in settings:
+                    self.max_megapixels = settings["max_megapixels"]
+                
+                if "incremental_export" in settings:
+                    self.incremental_export = settings["incremental_export"]
         except:
             pass  # 忽略无法加载的设置
     
@@ -839,11 +1465,32 @@ class WatermarkApp(QMainWindow):
         )
     
     def closeEvent(self, event):
+        # 停止正在进行的扫描
+        for scan_thread in list(self.scan_threads):
+            scan_thread.cancel()
+            scan_thread.wait()
+        
+        # 等待后台预览任务结束
+        self.preview_generation += 1
+        self.preview_pool.waitForDone()
+        self.image_model.shutdown()
+        
+        # 关闭前停止正在进行的导出
+        if self.export_thread is not None and self.export_thread.isRunning():
+            self.export_thread.cancel()
+            self.export_thread.wait()
+        if self.export_queue is not None:
+            self.export_queue.close()
+        self.metadata_index.close()
+        self.template_store.close()
+        
         # 在关闭前保存设置
         self.save_settings()
         event.accept()
 
 if __name__ == "__main__":
+    # 打包为exe后进程池需要
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     window = WatermarkApp()
     window.show()
@@ -0,0 +1,266 @@
+import sys
+import os
+import signal
+import argparse
+
+import watermark_core
+import encoders
+from export_engine import ExportEngine, default_worker_count, DEFAULT_IO_WORKERS, LARGE_IMAGE_PIXELS
+from folder_scanner import collect_image_files
+from exif_date import MetadataIndex
+from export_trace import ExportTrace
+from folder_watcher import WatchExporter, DEFAULT_SETTLE_TIME
+from template_store import TemplateStore, default_store_path
+
+
+def parse_target(spec):
+    # 名称:最长边:格式[:质量]；最长边为0表示原尺寸，名称为保存的子文件夹，为空时保存到输出文件夹
+    parts = spec.split(":")
+    if len(parts) not in (3, 4):
+        raise argparse.ArgumentTypeError(f"无效的输出目标: {spec}")
+    name, max_size, output_format = parts[0], parts[1], parts[2].upper()
+    if output_format not in watermark_core.OUTPUT_FORMATS:
+        raise argparse.ArgumentTypeError(f"不支持的输出格式: {output_format}")
+    try:
+        profile = {"name": name, "max_size": max(0, int(max_size or 0)), "output_format": output_format}
+        if len(parts) == 4:
+            profile["quality"] = max(1, min(100, int(parts[3])))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无效的输出目标: {spec}")
+    return profile
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="watermark",
+        description="不启动图形界面，批量为图片添加文本水印"
+    )
+    parser.add_argument("inputs", nargs="+", help="图片文件或文件夹")
+    parser.add_argument("-t", "--template", help="模板JSON文件，或模板库中的模板名称")
+    parser.add_argument("--template-folder", default=os.path.join(os.getcwd(), "templates"),
+                        help="模板库所在的文件夹（与图形界面相同）")
+    parser.add_argument("-s", "--settings", help="设置JSON文件（如 watermark_settings.json）")
+    parser.add_argument("-o", "--output", help="输出文件夹")
+    parser.add_argument("-j", "--workers", type=int, default=default_worker_count(), help="并行进程数")
+    parser.add_argument("--text", help="水印文本")
+    parser.add_argument("--opacity", type=int, help="透明度 0-100")
+    parser.add_argument("--format", choices=watermark_core.OUTPUT_FORMATS, help="输出格式")
+    parser.add_argument("--speed", choices=encoders.ENCODER_SPEEDS, help="编码方式：fast 最快，small 文件最小")
+    parser.add_argument("--quality", type=int, help="JPEG/WebP/AVIF 的编码质量")
+    parser.add_argument("--target", dest="targets", action="append", type=parse_target, metavar="名称:最长边:格式[:质量]",
+                        help="输出配置目标，可指定多个，如 web:2048:JPEG:85；每张图片只解码一次，生成所有目标")
+    parser.add_argument("--strip-metadata", action="store_true", help="不保留EXIF和ICC信息")
+    parser.add_argument("--date-stamp", action="store_true", help="使用每张图片的拍摄日期作为水印")
+    parser.add_argument("--date-format", help="日期格式，如 %%Y-%%m-%%d")
+    parser.add_argument("--date-fallback", choices=watermark_core.DATE_FALLBACKS,
+                        help="没有拍摄日期时：mtime 使用文件修改时间，none 不加水印")
+    parser.add_argument("--tiled", action="store_true", help="倾斜平铺水印，铺满整幅图片")
+    parser.add_argument("--tile-angle", type=int, help="平铺水印的角度（度）")
+    parser.add_argument("--tile-spacing", type=int, help="平铺水印之间的间距（像素）")
+    parser.add_argument("--logo", help="图片水印（Logo）文件，建议使用透明背景的PNG")
+    parser.add_argument("--logo-scale", type=int, help="Logo宽度占图片宽度的百分比")
+    parser.add_argument("--logo-opacity", type=int, help="Logo透明度 0-100")
+    parser.add_argument("--logo-position", choices=watermark_core.LOGO_POSITIONS, help="Logo位置")
+    parser.add_argument("--cache-dir", default=os.path.join(os.getcwd(), "cache"), help="日期索引等缓存所在的文件夹")
+    parser.add_argument("--io-workers", type=int, default=DEFAULT_IO_WORKERS, help="读取和写入文件的线程数")
+    parser.add_argument("--memory-limit", type=int, help="同时处理的图片估算内存上限（MB），超大图片会被单独处理")
+    parser.add_argument("--large-image-mp", type=int, default=LARGE_IMAGE_PIXELS // 1000000,
+                        help="超过该像素数（百万）的图片不预读到内存，由子进程直接读写文件")
+    parser.add_argument("--max-megapixels", type=int, help="允许处理的最大像素数（百万），用于放宽Pillow的解压炸弹保护")
+    parser.add_argument("-i", "--incremental", action="store_true", help="跳过源文件和设置都没有变化的图片")
+    parser.add_argument("--trace", help="保存各阶段耗时记录：.jsonl 为每行一条记录，其他扩展名为 Chrome trace")
+    parser.add_argument("--profile", help="使用cProfile分析渲染过程，结果保存为 .prof 文件")
+    parser.add_argument("--report", action="store_true", help="导出结束后输出各阶段耗时汇总")
+    parser.add_argument("-w", "--watch", action="store_true", help="持续监视输入文件夹，新图片写完后立即加水印（Ctrl+C 退出）")
+    parser.add_argument("--poll", action="store_true", help="监视时使用轮询而不是inotify（如网络文件夹）")
+    parser.add_argument("--settle", type=float, default=DEFAULT_SETTLE_TIME, help="文件停止变化多少秒后认为已经写完")
+    parser.add_argument("-q", "--quiet", action="store_true", help="不输出进度")
+    return parser
+
+
+def load_template(name, template_folder):
+    # 优先作为模板文件读取，否则在模板库中按名称查找
+    if os.path.isfile(name):
+        return watermark_core.read_json_file(name)
+    if not os.path.isdir(template_folder):
+        raise ValueError(f"找不到模板: {name}")
+    store = TemplateStore(default_store_path(template_folder))
+    try:
+        store.sync_folder(template_folder)
+        template = store.get(name)
+    finally:
+        store.close()
+    if template is None:
+        raise ValueError(f"找不到模板: {name}")
+    return template
+
+
+def build_settings(args):
+    # 优先级：命令行参数 > 模板 > 设置文件 > 默认值
+    settings = dict(watermark_core.DEFAULT_SETTINGS)
+    if args.settings:
+        settings = watermark_core.load_settings_file(args.settings, settings)
+    if args.template:
+        settings = watermark_core.merge_settings(settings, load_template(args.template, args.template_folder))
+    if args.text is not None:
+        settings["watermark_text"] = args.text
+    if args.opacity is not None:
+        settings["text_opacity"] = max(0, min(100, args.opacity))
+    if args.format:
+        settings["output_format"] = args.format
+    if args.speed:
+        settings["encoder_speed"] = args.speed
+    if args.quality is not None:
+        # 只覆盖当前输出格式的质量参数
+        profiles = {key: dict(value) for key, value in settings.get("encoder_profiles", {}).items()}
+        profiles.setdefault(settings["output_format"], {})["quality"] = max(1, min(100, args.quality))
+        settings["encoder_profiles"] = profiles
+    if args.targets:
+        settings["output_profiles"] = args.targets
+    if args.strip_metadata:
+        settings["keep_metadata"] = False
+    if args.date_stamp:
+        settings["watermark_mode"] = "date"
+    if args.date_format:
+        settings["date_format"] = args.date_format
+    if args.date_fallback:
+        settings["date_fallback"] = args.date_fallback
+    if args.tiled:
+        settings["watermark_layout"] = "tiled"
+    if args.tile_angle is not None:
+        settings["tile_angle"] = args.tile_angle
+    if args.tile_spacing is not None:
+        settings["tile_spacing"] = max(0, args.tile_spacing)
+    if args.logo:
+        settings["logo_path"] = os.path.abspath(args.logo)
+    if args.logo_scale is not None:
+        settings["logo_scale"] = max(1, min(100, args.logo_scale))
+    if args.logo_opacity is not None:
+        settings["logo_opacity"] = max(0, min(100, args.logo_opacity))
+    if args.logo_position:
+        settings["logo_position"] = args.logo_position
+    if args.output:
+        settings["output_folder"] = os.path.abspath(args.output)
+    return settings
+
+
+def open_metadata_index(settings, cache_dir):
+    if settings.get("watermark_mode") != "date":
+        return None
+    try:
+        return MetadataIndex(os.path.join(cache_dir, "metadata.db"))
+    except Exception as e:
+        print(f"警告: 无法打开日期索引 - {e}", file=sys.stderr)
+        return MetadataIndex()
+
+
+def watch(args, settings, max_image_pixels):
+    # 监视模式：一直运行，直到按下 Ctrl+C 或收到 SIGTERM
+    folders = [path for path in args.inputs if os.path.isdir(path)]
+    if not folders:
+        print("错误: 监视模式需要至少一个文件夹", file=sys.stderr)
+        return 2
+
+    def on_exported(file_path, output_paths, error, seconds):
+        if error:
+            print(f"失败 {file_path}: {error}", file=sys.stderr)
+        elif not args.quiet:
+            print(f"{file_path} -> {', '.join(output_paths)} ({seconds * 1000:.0f} ms)", file=sys.stderr)
+
+    def on_ready():
+        print(f"正在监视: {', '.join(folders)}（按 Ctrl+C 退出）", file=sys.stderr)
+
+    metadata_index = open_metadata_index(settings, args.cache_dir)
+    exporter = WatchExporter(
+        folders, settings, args.workers, metadata_index, settle_time=args.settle, polling=args.poll,
+        max_image_pixels=max_image_pixels
+    )
+    for warning in exporter.warnings:
+        print(f"警告: {warning}", file=sys.stderr)
+    # 由服务管理器停止时（SIGTERM）同样等待正在处理的图片完成并保存导出清单
+    previous_handler = signal.signal(signal.SIGTERM, lambda signum, frame: exporter.stop())
+    try:
+        exporter.run(on_exported, on_ready)
+        print("已停止监视", file=sys.stderr)
+    except KeyboardInterrupt:
+        print("已停止监视", file=sys.stderr)
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+        if metadata_index is not None:
+            metadata_index.close()
+    return 0
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    try:
+        settings = build_settings(args)
+    except (OSError, ValueError) as e:
+        print(f"错误: 无法读取设置 - {e}", file=sys.stderr)
+        return 2
+    try:
+        watermark_core.output_targets(settings)
+    except ValueError as e:
+        print(f"错误: {e}", file=sys.stderr)
+        return 2
+
+    for path in args.inputs:
+        if not os.path.exists(path):
+            print(f"警告: 找不到 {path}", file=sys.stderr)
+
+    max_image_pixels = args.max_megapixels * 1000000 if args.max_megapixels else None
+    watermark_core.configure_image_limits(max_image_pixels)
+
+    if args.watch:
+        return watch(args, settings, max_image_pixels)
+
+    # 输出文件夹位于输入文件夹中时不重复处理已导出的图片
+    file_paths = collect_image_files(args.inputs, ignore_paths=[settings["output_folder"]])
+    if not file_paths:
+        print("没有图片可导出", file=sys.stderr)
+        return 1
+
+    def on_progress(done, total, file_path, error):
+        if error:
+            print(f"[{done}/{total}] 失败 {file_path}: {error}", file=sys.stderr)
+        elif not args.quiet:
+            print(f"[{done}/{total}] {file_path}", file=sys.stderr)
+
+    metadata_index = open_metadata_index(settings, args.cache_dir)
+    trace = ExportTrace(profile=bool(args.profile)) if (args.trace or args.profile or args.report) else None
+    engine = ExportEngine(
+        settings, args.workers, args.incremental, metadata_index, args.io_workers, trace,
+        memory_limit=args.memory_limit * 1024 * 1024 if args.memory_limit else None,
+        large_image_pixels=args.large_image_mp * 1000000, max_image_pixels=max_image_pixels
+    )
+    for warning in engine.warnings:
+        print(f"警告: {warning}", file=sys.stderr)
+    try:
+        succeeded, failures = engine.run(file_paths, on_progress)
+    except KeyboardInterrupt:
+        engine.cancel()
+        print("已取消", file=sys.stderr)
+        return 130
+    finally:
+        if metadata_index is not None:
+            metadata_index.close()
+
+    if trace is not None:
+        if args.report:
+            print(trace.format_summary(), file=sys.stderr)
+        try:
+            if args.trace:
+                trace.save(args.trace)
+            if args.profile:
+                trace.save_profile(args.profile)
+        except OSError as e:
+            print(f"警告: 无法保存耗时记录 - {e}", file=sys.stderr)
+
+    skipped_text = f"，跳过未变化的 {engine.skipped} 张" if engine.skipped else ""
+    print(f"导出完成！共 {succeeded} 张图片{skipped_text}，保存至: {settings['output_folder']}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
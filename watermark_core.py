@@ -0,0 +1,568 @@
+import os
+import io
+import json
+import threading
+from datetime import datetime
+from PIL import Image, ImageOps
+
+from render_cache import get_text_sprite, get_pattern_mask, get_logo, measure_text, cache_stats
+from export_trace import stage, count, run_traced
+from exif_date import read_capture_date
+from encoders import available_formats, encode_image, source_metadata, EXIF_ORIENTATION
+
+# 支持导入的图片格式
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff')
+
+# 支持导出的图片格式（WebP、AVIF取决于安装的Pillow是否支持）
+OUTPUT_FORMATS = available_formats()
+
+# 命名规则
+NAMING_RULES = ["original", "prefix", "suffix"]
+
+# 水印内容：自定义文本或拍摄日期
+WATERMARK_MODES = ["text", "date"]
+
+# 水印布局：单个水印或铺满整幅图片的倾斜平铺水印（防裁剪）
+WATERMARK_LAYOUTS = ["single", "tiled"]
+
+# 图片水印（Logo）的位置
+LOGO_POSITIONS = ["top_left", "top_right", "bottom_left", "bottom_right", "center"]
+
+# 没有拍摄日期时的处理方式：使用文件修改时间或不加水印
+DATE_FALLBACKS = ["mtime", "none"]
+
+# 默认设置
+DEFAULT_SETTINGS = {
+    "watermark_text": "水印",
+    "text_opacity": 50,
+    "watermark_position": {"x": 0, "y": 0},
+    "output_format": "PNG",
+    "output_folder": os.path.join(os.getcwd(), "output"),
+    "file_naming_rule": "original",
+    "custom_prefix": "wm_",
+    "custom_suffix": "_watermarked",
+    "watermark_mode": "text",
+    "date_format": "%Y-%m-%d",
+    "date_fallback": "mtime",
+    "watermark_layout": "single",
+    "tile_angle": 30,
+    "tile_spacing": 100,
+    "logo_path": "",
+    "logo_scale": 20,
+    "logo_opacity": 0,
+    "logo_position": "top_left",
+    "encoder_speed": "balanced",
+    "encoder_profiles": {},
+    "keep_metadata": True,
+    "output_profiles": []
+}
+
+# 模板中保存的设置项
+TEMPLATE_KEYS = [
+    "watermark_text", "text_opacity", "output_format",
+    "file_naming_rule", "custom_prefix", "custom_suffix",
+    "watermark_mode", "date_format", "date_fallback",
+    "watermark_layout", "tile_angle", "tile_spacing",
+    "logo_path", "logo_scale", "logo_opacity", "logo_position",
+    "encoder_speed", "encoder_profiles", "keep_metadata", "output_profiles"
+]
+
+# 输出配置中每个目标可以覆盖的设置项；另有 name（子文件夹）、max_size（最长边像素，0为原尺寸）、quality
+TARGET_KEYS = [
+    "output_format", "file_naming_rule", "custom_prefix", "custom_suffix", "encoder_speed", "keep_metadata"
+]
+
+SETTINGS_FILE_NAME = "watermark_settings.json"
+
+# Pillow默认的解压炸弹保护上限
+DEFAULT_MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS
+
+# Pillow内部每像素占用的字节数（RGB按4字节存储），用于估算解码后的内存
+BYTES_PER_PIXEL = {"1": 1, "L": 1, "P": 1, "I;16": 2, "LA": 4, "PA": 4, "RGB": 4, "RGBA": 4, "CMYK": 4, "YCbCr": 4, "I": 4, "F": 4}
+
+# 水印字体和颜色
+FONT_PATH = "simhei.ttf"
+WATERMARK_COLOR = (255, 0, 0)
+
+
+def is_image_file(file_name):
+    return file_name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def read_json_file(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_json_file(data, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+
+
+def merge_settings(base, overrides):
+    # 返回新的设置字典，不修改传入的字典
+    settings = dict(base)
+    settings.update(overrides)
+    return settings
+
+
+def load_settings_file(path, base=None):
+    return merge_settings(base or DEFAULT_SETTINGS, read_json_file(path))
+
+
+def template_from_settings(settings):
+    return {key: settings[key] for key in TEMPLATE_KEYS if key in settings}
+
+
+def resolve_watermark_text(settings, file_path, metadata_index=None):
+    # 日期模式下返回该图片的拍摄日期文本，否则返回设置中的水印文本
+    if settings.get("watermark_mode", "text") != "date":
+        return settings["watermark_text"]
+
+    try:
+        if metadata_index is not None:
+            capture_date = metadata_index.get_capture_date(file_path)
+        else:
+            capture_date = read_capture_date(file_path)
+        if capture_date is None and settings.get("date_fallback", "mtime") == "mtime":
+            capture_date = datetime.fromtimestamp(os.path.getmtime(file_path))
+    except Exception:
+        capture_date = None
+
+    if capture_date is None:
+        return ""
+    try:
+        return capture_date.strftime(settings.get("date_format") or "%Y-%m-%d")
+    except ValueError:
+        return capture_date.strftime("%Y-%m-%d")
+
+
+def settings_for_file(settings, file_path, metadata_index=None):
+    # 返回针对单张图片的设置（日期模式下水印文本为该图片的日期）
+    if settings.get("watermark_mode", "text") != "date":
+        return settings
+    return dict(settings, watermark_text=resolve_watermark_text(settings, file_path, metadata_index))
+
+
+def compute_text_layout(image_size, settings):
+    # 按原图尺寸计算字体大小和水印位置，返回 (字号, 位置)
+    width, height = image_size
+
+    # 计算字体大小
+    font_size = max(12, min(width, height) // 20)
+
+    x = settings["watermark_position"]["x"]
+    y = settings["watermark_position"]["y"]
+
+    # 获取文本尺寸（字体和尺寸都从缓存中获取，同尺寸的图片只需读取一次字体文件）
+    bbox = measure_text(settings["watermark_text"], FONT_PATH, font_size)
+    text_width = bbox[2] - bbox[0]
+    text_height = bbox[3] - bbox[1]
+
+    # 计算水印位置
+    if x == 0 and y == 0:
+        # 默认位置：右下角，确保文本不会超出边界
+        return font_size, (width - text_width - 20, height - text_height - 20)
+
+    # 检查并纠正文本是否会超出边界
+    # 对于右侧位置
+    if x > width - text_width - 20:
+        x = width - text_width - 20
+    # 对于底部位置
+    if y > height - text_height - 20:
+        y = height - text_height - 20
+    # 确保位置不为负数
+    x = max(20, x)
+    y = max(20, y)
+
+    return font_size, (x, y)
+
+
+def add_watermark_to_image(image, settings, copy=True, full_size=None):
+    # 保持图片原有模式，只对水印所在区域做混合；copy=False 时直接在传入的图片上修改
+    # full_size 为原图尺寸：传入缩小后的预览图时，按原图计算布局再缩放到预览尺寸
+    with stage("convert"):
+        watermarked_image = convert_for_output(image, settings["output_format"], copy)
+
+    full_size = full_size or watermarked_image.size
+    scale = watermarked_image.width / full_size[0]
+    font_size, position = compute_text_layout(full_size, settings)
+    if scale != 1:
+        font_size = max(1, round(font_size * scale))
+        position = (round(position[0] * scale), round(position[1] * scale))
+
+    # 透明度计算公式
+    opacity = int(255 * (1 - settings["text_opacity"] / 100))
+
+    if settings.get("watermark_layout", "single") == "tiled":
+        # 平铺水印：整幅蒙版按图片尺寸缓存，每张图片只需一次带蒙版的颜色填充
+        if settings["watermark_text"].strip():
+            spacing = max(0, round(settings.get("tile_spacing", 100) * scale))
+            with stage("draw"):
+                mask = get_pattern_mask(
+                    settings["watermark_text"], FONT_PATH, font_size, opacity,
+                    settings.get("tile_angle", 30), spacing, watermarked_image.size
+                )
+                color = WATERMARK_COLOR + (255,) if watermarked_image.mode == 'RGBA' else WATERMARK_COLOR
+                watermarked_image.paste(color, (0, 0) + watermarked_image.size, mask)
+    else:
+        # 绘制文本水印：使用预先栅格化的图章，只混合水印所在区域
+        with stage("draw"):
+            sprite, offset = get_text_sprite(settings["watermark_text"], FONT_PATH, font_size, opacity, WATERMARK_COLOR)
+            composite_sprite(watermarked_image, sprite, (position[0] + offset[0], position[1] + offset[1]))
+
+    if settings.get("logo_path"):
+        add_logo_to_image(watermarked_image, settings, scale)
+
+    return watermarked_image
+
+
+def compute_logo_position(image_size, logo_size, position, margin):
+    width, height = image_size
+    if position == "center":
+        return (width - logo_size[0]) // 2, (height - logo_size[1]) // 2
+    x = width - logo_size[0] - margin if position in ("top_right", "bottom_right") else margin
+    y = height - logo_size[1] - margin if position in ("bottom_left", "bottom_right") else margin
+    return x, y
+
+
+def check_logo(settings):
+    # 导出或预览开始前检查一次Logo图片；找不到或无法读取时返回去掉Logo的设置和警告信息，
+    # 只跳过Logo，不让每张图片都因为Logo失败
+    logo_path = settings.get("logo_path")
+    if not logo_path:
+        return settings, None
+    try:
+        with Image.open(logo_path):
+            pass
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        return dict(settings, logo_path=""), f"无法读取Logo图片，已跳过Logo: {e}"
+    return settings, None
+
+
+def add_logo_to_image(image, settings, scale=1):
+    # Logo宽度为图片宽度的 logo_scale%，缩放结果按尺寸缓存，同尺寸的图片不再重复缩放
+    width = max(1, round(image.width * settings.get("logo_scale", 20) / 100))
+    alpha = int(255 * (1 - settings.get("logo_opacity", 0) / 100))
+    with stage("draw"):
+        logo = get_logo(settings["logo_path"], width, alpha)
+        position = compute_logo_position(
+            image.size, logo.size, settings.get("logo_position", "top_left"), round(20 * scale)
+        )
+        composite_sprite(image, logo, position)
+
+
+def image_orientation(image):
+    # EXIF方向标签，没有或无法读取时为1（正常方向）
+    try:
+        return image.getexif().get(EXIF_ORIENTATION, 1)
+    except Exception:
+        return 1
+
+
+def oriented_size(size, orientation):
+    # 方向标签5~8表示需要旋转90度，显示尺寸的宽高与存储的相反
+    return (size[1], size[0]) if orientation in (5, 6, 7, 8) else size
+
+
+def apply_orientation(image, orientation):
+    # 按方向标签旋转像素，水印按看图软件显示的画面布局；正常方向时不复制图片
+    if orientation in (2, 3, 4, 5, 6, 7, 8):
+        return ImageOps.exif_transpose(image)
+    return image
+
+
+def has_alpha(image):
+    return image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+
+
+def convert_for_output(image, output_format, copy=True):
+    # 只在必要时转换整幅图片：RGB/RGBA保持原样，其他模式转换为能显示彩色水印的模式
+    if output_format == 'JPEG':
+        if image.mode == 'RGB':
+            return image.copy() if copy else image
+        if has_alpha(image):
+            # 透明区域以白色为背景
+            rgba_image = image if image.mode == 'RGBA' else image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(rgba_image, mask=rgba_image.getchannel('A'))
+            return background
+        return image.convert('RGB')
+
+    if image.mode in ('RGB', 'RGBA'):
+        return image.copy() if copy else image
+    return image.convert('RGBA' if has_alpha(image) else 'RGB')
+
+
+def output_mode(image, output_format):
+    # convert_for_output 转换后的模式；JPEG 的RGB结果与其他格式的RGBA结果来自不同的转换
+    if output_format == 'JPEG':
+        return 'RGB'
+    if image.mode in ('RGB', 'RGBA'):
+        return image.mode
+    return 'RGBA' if has_alpha(image) else 'RGB'
+
+
+def composite_sprite(image, sprite, position):
+    # 将RGBA图章混合到图像的指定位置，超出图像边界的部分被裁掉
+    x, y = int(position[0]), int(position[1])
+    left, top = max(0, x), max(0, y)
+    right = min(image.width, x + sprite.width)
+    bottom = min(image.height, y + sprite.height)
+    if right <= left or bottom <= top:
+        return
+    source = (left - x, top - y, right - x, bottom - y)
+
+    if image.mode == 'RGBA':
+        image.alpha_composite(sprite, dest=(left, top), source=source)
+    else:
+        # 只裁剪水印区域进行混合，再贴回原图，避免整幅图片转换为RGBA
+        box = (left, top, right, bottom)
+        region = image.crop(box).convert('RGBA')
+        region.alpha_composite(sprite, source=source)
+        image.paste(region.convert(image.mode), box)
+
+
+def get_output_name(file_path, settings):
+    # 根据命名规则确定输出文件名
+    base_name, _ = os.path.splitext(os.path.basename(file_path))
+    ext = settings["output_format"].lower()
+
+    if settings["file_naming_rule"] == "prefix":
+        return f"{settings['custom_prefix']}{base_name}.{ext}"
+    elif settings["file_naming_rule"] == "suffix":
+        return f"{base_name}{settings['custom_suffix']}.{ext}"
+    return f"{base_name}.{ext}"
+
+
+def output_targets(settings):
+    # 输出配置：一次导出生成多个尺寸和格式的版本，返回每个目标的完整设置
+    # 没有配置输出配置时只有当前设置本身
+    profiles = settings.get("output_profiles") or []
+    if not profiles:
+        return [settings]
+    targets = []
+    for profile in profiles:
+        target = {key: value for key, value in settings.items() if key != "output_profiles"}
+        target.update((key, profile[key]) for key in TARGET_KEYS if key in profile)
+        if "quality" in profile:
+            encoder_profiles = {key: dict(value) for key, value in settings.get("encoder_profiles", {}).items()}
+            encoder_profiles.setdefault(target["output_format"], {})["quality"] = profile["quality"]
+            target["encoder_profiles"] = encoder_profiles
+        target["max_size"] = max(0, int(profile.get("max_size") or 0))
+        # 每个目标保存到以名称命名的子文件夹中，不同尺寸的同名文件不会互相覆盖
+        target["output_subfolder"] = os.path.basename(str(profile.get("name") or ""))
+        targets.append(target)
+    check_output_targets(targets)
+    return targets
+
+
+def check_output_targets(targets):
+    # 同一张图片的各个目标必须写到不同的文件，否则后写的目标会覆盖前面的输出
+    seen = {}
+    for index, target in enumerate(targets):
+        key = os.path.normcase(os.path.join(target.get("output_subfolder", ""), get_output_name("image", target)))
+        if key in seen:
+            folder = target.get("output_subfolder") or "输出文件夹"
+            raise ValueError(
+                f"输出配置中第 {seen[key] + 1} 个和第 {index + 1} 个目标的输出路径相同"
+                f"（{folder}，格式 {target['output_format']}），请为它们设置不同的名称"
+            )
+        seen[key] = index
+
+
+def get_output_path(file_path, settings):
+    return os.path.join(
+        settings["output_folder"], settings.get("output_subfolder", ""), get_output_name(file_path, settings)
+    )
+
+
+def output_folders(settings):
+    return sorted({os.path.join(target["output_folder"], target.get("output_subfolder", ""))
+                   for target in output_targets(settings)})
+
+
+def target_size(size, max_size):
+    # 按最长边等比缩小，不放大
+    if not max_size or max(size) <= max_size:
+        return size
+    ratio = max_size / max(size)
+    return max(1, round(size[0] * ratio)), max(1, round(size[1] * ratio))
+
+
+def configure_image_limits(max_image_pixels=None):
+    # 放宽Pillow的解压炸弹保护，允许处理可信的超大扫描图；None 表示使用Pillow的默认上限
+    Image.MAX_IMAGE_PIXELS = max_image_pixels or DEFAULT_MAX_IMAGE_PIXELS
+
+
+def estimate_render_memory(size, mode, settings, source_bytes=0):
+    # 粗略估算渲染一张图片的峰值内存（字节）：源文件数据 + 解码结果 + 模式转换副本 + 编码结果
+    pixels = size[0] * size[1]
+    decoded = pixels * BYTES_PER_PIXEL.get(mode, 4)
+    converted = encoded = pattern = 0
+    for target in output_targets(settings):
+        target_pixels = pixels
+        if target.get("max_size"):
+            width, height = target_size(size, target["max_size"])
+            target_pixels = width * height
+        output_format = target["output_format"]
+        # 缩小的目标需要缩放后的副本，原尺寸的目标只在模式不同时转换
+        keeps_mode = target_pixels == pixels and (mode == 'RGB' or (mode == 'RGBA' and output_format != 'JPEG'))
+        converted += 0 if keeps_mode else target_pixels * 4
+        encoded += target_pixels * (3 if output_format == 'PNG' else 1)
+        # 平铺水印还需要一张与图片等大的蒙版
+        if settings.get("watermark_layout") == "tiled":
+            pattern = max(pattern, target_pixels)
+    return source_bytes + decoded + converted + encoded + pattern
+
+
+class SourceImageError(ValueError):
+    # 源图片无法识别或解码（文件损坏、格式不支持、超过像素上限），与渲染和编码中的错误区分
+    pass
+
+
+def open_source(fp):
+    try:
+        return Image.open(fp)
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        raise SourceImageError(str(e)) from e
+
+
+def read_source(file_path):
+    with stage("read"):
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    count("bytes_read", len(data))
+    return data
+
+
+def render_opened_targets(image, fps, targets):
+    # 解码一次 -> 每种尺寸缩放并添加一次水印 -> 编码为该尺寸的所有目标，fps 与 targets 一一对应
+    # 水印布局按原图尺寸计算后等比缩放，各尺寸的水印位置和比例一致
+    stored_size = image.size
+    with stage("decode"):
+        # 所有目标都比原图小时，JPEG 直接以 1/2、1/4、1/8 的尺寸解码
+        # 按最长边缩小与宽高顺序无关，这里按存储方向计算
+        largest = max((target_size(stored_size, target.get("max_size", 0)) for target in targets),
+                      key=lambda size: size[0] * size[1])
+        try:
+            if image.format == 'JPEG' and largest != stored_size:
+                image.draft(image.mode, largest)
+            image.load()
+        except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+            raise SourceImageError(str(e)) from e
+        metadata = source_metadata(image)
+        orientation = image_orientation(image)
+        image = apply_orientation(image, orientation)
+    full_size = oriented_size(stored_size, orientation)
+    sizes = [target_size(full_size, target.get("max_size", 0)) for target in targets]
+
+    # 从大到小依次缩放，较小的尺寸从上一级的缩放结果缩小
+    source = image
+    ordered_sizes = sorted(set(sizes), key=lambda size: size[0] * size[1], reverse=True)
+    for size_index, size in enumerate(ordered_sizes):
+        if source.size != size:
+            with stage("resize"):
+                # resize 对调色板等模式只能使用最近邻插值，先转换
+                if source.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+                    source = source.convert('RGBA' if has_alpha(source) else 'RGB')
+                source = source.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+        # 同一尺寸中转换后模式相同的目标共用一次水印绘制
+        groups = {}
+        for index, target in enumerate(targets):
+            if sizes[index] == size:
+                groups.setdefault(output_mode(source, target["output_format"]), []).append(index)
+        for group_index, indexes in enumerate(groups.values()):
+            # 源图片之后还要用于缩放或其他模式时在副本上绘制水印，最后一次使用时直接在其上绘制
+            last_use = size_index == len(ordered_sizes) - 1 and group_index == len(groups) - 1
+            watermarked_image = add_watermark_to_image(source, targets[indexes[0]], copy=not last_use, full_size=full_size)
+            for index in indexes:
+                with stage("encode"):
+                    encode_image(watermarked_image, fps[index], targets[index]["output_format"], targets[index], metadata)
+
+
+def render_opened_image(image, fp, settings):
+    # 解码 -> 添加水印 -> 编码到 fp
+    # 解码得到的图片只在这里使用，直接在其上绘制水印，不再复制一份
+    render_opened_targets(image, [fp], [settings])
+
+
+def render_image_bytes(data, settings):
+    # 输入和输出都是内存中的文件数据
+    return render_image_targets(data, [settings])[0]
+
+
+def render_image_targets(data, targets):
+    # 返回与 targets 对应的输出数据列表
+    with open_source(io.BytesIO(data)) as image:
+        buffers = [io.BytesIO() for _ in targets]
+        render_opened_targets(image, buffers, targets)
+    return [buffer.getvalue() for buffer in buffers]
+
+
+def render_image_file(file_path, output_path, settings):
+    return render_image_file_targets(file_path, [output_path], [settings])[0]
+
+
+def render_image_file_targets(file_path, output_paths, targets):
+    # 大图模式：子进程直接从源文件解码并编码到输出文件
+    # 源文件数据和编码结果都不在内存中整份保存，也不经过进程间传输
+    temp_paths = [f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp" for output_path in output_paths]
+    files = []
+    try:
+        with open_source(file_path) as image:
+            try:
+                files.extend(open(temp_path, 'wb') for temp_path in temp_paths)
+                render_opened_targets(image, files, targets)
+            finally:
+                for f in files:
+                    f.close()
+        for temp_path, output_path in zip(temp_paths, output_paths):
+            os.replace(temp_path, output_path)
+    except BaseException:
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        raise
+    count("bytes_read", os.path.getsize(file_path))
+    count("bytes_written", sum(os.path.getsize(output_path) for output_path in output_paths))
+    return output_paths
+
+
+def render_image_traced(data, targets, profile=False):
+    # 在导出子进程中调用：渲染并返回各阶段耗时、缓存命中次数和可选的cProfile数据
+    return run_traced(render_image_targets, (data, targets), profile, cache_stats)
+
+
+def render_image_file_traced(file_path, output_paths, targets, profile=False):
+    return run_traced(render_image_file_targets, (file_path, output_paths, targets), profile, cache_stats)
+
+
+def write_output_atomic(data, output_path):
+    # 先写入同一文件夹中的临时文件再重命名，中途失败不会留下不完整的输出文件
+    temp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with stage("write"):
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, output_path)
+        count("bytes_written", len(data))
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return output_path
+
+
+def write_outputs_atomic(outputs, output_paths):
+    # 依次写出同一张图片的所有输出目标
+    for data, output_path in zip(outputs, output_paths):
+        write_output_atomic(data, output_path)
+    return output_paths
+
+
+def export_image(file_path, settings):
+    # 读取 -> 渲染 -> 写入，返回输出路径
+    output_path = os.path.join(settings["output_folder"], get_output_name(file_path, settings))
+    return write_output_atomic(render_image_bytes(read_source(file_path), settings), output_path)
@@ -0,0 +1,463 @@
+import io
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait
+from urllib.parse import urlsplit, parse_qsl
+
+import watermark_core
+from watermark_core import settings_for_file, render_image_bytes, read_source, configure_image_limits, SourceImageError
+from export_engine import default_worker_count
+from template_store import TemplateStore, default_store_path
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# 请求体大小上限（字节）
+MAX_BODY_SIZE = 256 * 1024 * 1024
+
+# 同一模板的请求在该时间窗口（秒）内合并为一批提交给进程池，每批最多的图片数
+DEFAULT_BATCH_WINDOW = 0.002
+DEFAULT_MAX_BATCH = 4
+
+# 已接受但尚未完成的请求数上限，超过时直接返回503，排队时间不会无限增长
+DEFAULT_MAX_PENDING = 64
+
+# 用于统计延迟分位数的最近请求数
+LATENCY_SAMPLES = 2048
+
+# 每隔多少秒检查一次模板文件夹中新增或修改的JSON模板
+TEMPLATE_SYNC_INTERVAL = 5.0
+
+CONTENT_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp", "AVIF": "image/avif"}
+
+STATUS_TEXT = {
+    200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+    411: "Length Required", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def init_worker(max_image_pixels):
+    # 子进程忽略 Ctrl+C，由主进程关闭进程池
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    configure_image_limits(max_image_pixels)
+
+
+def render_batch(items):
+    # 在子进程中渲染一批图片；items 为 [(图片数据或文件路径, 设置), ...]
+    # 返回 [(输出数据, 错误信息或None, 是否为服务端错误), ...]，一张图片失败不影响同一批的其他图片
+    # 读取不到或无法解码的图片是请求的问题，其他错误（内存不足、编码失败等）是服务端的问题
+    results = []
+    for source, settings in items:
+        try:
+            if isinstance(source, str):
+                try:
+                    data = read_source(source)
+                except OSError as e:
+                    raise SourceImageError(str(e)) from e
+                settings = settings_for_file(settings, source)
+            else:
+                # 上传的图片没有文件路径，日期模式下从上传数据的EXIF中读取拍摄日期
+                data = source
+                settings = settings_for_file(settings, io.BytesIO(data))
+            results.append((render_image_bytes(data, settings), None, False))
+        except SourceImageError as e:
+            results.append((None, str(e), False))
+        except Exception as e:
+            results.append((None, str(e) or type(e).__name__, True))
+    return results
+
+
+class TemplateLibrary:
+    # 按名称从模板库（与图形界面共用）读取模板，模板修改后自动重新读取
+    # 模板文件夹中新增或修改的JSON模板由服务在后台线程中定期导入模板库，不阻塞请求
+    def __init__(self, folder, base_settings=None):
+        self.folder = folder
+        self.base_settings = self.check_logo(dict(base_settings or watermark_core.DEFAULT_SETTINGS), "基础设置")
+        self.store = TemplateStore(default_store_path(folder))
+        self._cache = {}
+
+    def check_logo(self, settings, name):
+        # Logo图片不可用时跳过Logo并提示一次，不让每个请求都失败
+        settings, warning = watermark_core.check_logo(settings)
+        if warning:
+            print(f"警告: {name} - {warning}", file=sys.stderr)
+        return settings
+
+    def sync(self):
+        return self.store.sync_folder(self.folder)
+
+    def names(self):
+        return self.store.names()
+
+    def get(self, name):
+        # 没有指定模板时使用基础设置；模板不存在时抛出 KeyError
+        if not name:
+            return self.base_settings
+        updated = self.store.updated(name)
+        if updated is None:
+            raise KeyError(name)
+        cached = self._cache.get(name)
+        if cached is None or cached[0] != updated:
+            template = self.store.get(name)
+            if template is None:
+                raise KeyError(name)
+            settings = self.check_logo(watermark_core.merge_settings(self.base_settings, template), f"模板 {name}")
+            cached = self._cache[name] = (updated, settings)
+        return cached[1]
+
+    def close(self):
+        self.store.close()
+
+
+class RenderBatcher:
+    # 把同一设置的请求合并成一批交给常驻进程池；同时提交的批次数有上限
+    # 进程池忙时新请求在等待中的批次里累积，负载越高每批越大，进程间传输和调度的开销越小
+    def __init__(self, executor, max_batches, window=DEFAULT_BATCH_WINDOW, max_batch=DEFAULT_MAX_BATCH):
+        self.executor = executor
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self.batches = 0
+        self.batched_items = 0
+        self._slots = asyncio.Semaphore(max(1, max_batches))
+        self._open = {}
+        self._tasks = set()
+
+    async def render(self, key, source, settings):
+        future = asyncio.get_running_loop().create_future()
+        batch = self._open.get(key)
+        if batch is None or len(batch) >= self.max_batch:
+            batch = self._open[key] = []
+            task = asyncio.ensure_future(self._run(key, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        batch.append((source, settings, future))
+        return await future
+
+    async def _run(self, key, batch):
+        await asyncio.sleep(self.window)
+        async with self._slots:
+            # 拿到提交名额后这一批不再接收新的请求
+            if self._open.get(key) is batch:
+                del self._open[key]
+            self.batches += 1
+            self.batched_items += len(batch)
+            try:
+                results = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, render_batch, [(source, settings) for source, settings, _ in batch]
+                )
+            except Exception as e:
+                results = [(None, f"渲染进程出错: {e}", True)] * len(batch)
+        for (_, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class WatermarkServer:
+    # 本地HTTP水印服务：
+    #   POST /watermark?template=名称&format=JPEG   请求体为图片数据，返回加水印后的图片
+    #   POST /watermark  Content-Type: application/json  {"path": 文件路径, "template": 名称, "format": 格式}
+    #   GET  /templates   模板列表
+    #   GET  /stats       请求数、批次大小和延迟分位数
+    def __init__(self, template_folder, max_workers=None, max_pending=DEFAULT_MAX_PENDING,
+                 batch_window=DEFAULT_BATCH_WINDOW, max_batch=DEFAULT_MAX_BATCH, allowed_paths=(),
+                 max_image_pixels=None, base_settings=None):
+        self.templates = TemplateLibrary(template_folder, base_settings)
+        self.max_workers = max(1, max_workers or default_worker_count())
+        self.max_pending = max(1, max_pending)
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.allowed_paths = [os.path.realpath(path) for path in allowed_paths]
+        self.max_image_pixels = max_image_pixels
+        self.pending = 0
+        self.requests = 0
+        self.rejected = 0
+        self.failed = 0
+        self.internal_errors = 0
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._executor = None
+        self._batcher = None
+        self._stop_event = None
+
+    def start_workers(self):
+        # 常驻进程池，预先启动所有子进程；字体、水印图章等缓存在各子进程中跨请求保留
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker, initargs=(self.max_image_pixels,)
+        )
+        wait([self._executor.submit(configure_image_limits, self.max_image_pixels) for _ in range(self.max_workers)])
+
+    def stop(self):
+        # 在事件循环所在的线程中调用
+        if self._stop_event is not None:
+            self._stop_event.set()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        self.templates.close()
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT, ready_callback=None):
+        if self._executor is None:
+            self.start_workers()
+        # 同时提交到进程池的批次数为进程数的两倍：子进程处理完一批时下一批已经在队列中
+        self._batcher = RenderBatcher(self._executor, self.max_workers * 2, self.batch_window, self.max_batch)
+        self._stop_event = asyncio.Event()
+        try:
+            # 收到 SIGTERM 时正常关闭服务和进程池
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self._stop_event.set)
+        except (NotImplementedError, AttributeError):  # Windows
+            pass
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.templates.sync)
+        sync_task = asyncio.ensure_future(self.sync_templates())
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        if ready_callback:
+            ready_callback(server.sockets[0].getsockname())
+        try:
+            async with server:
+                await self._stop_event.wait()
+        finally:
+            sync_task.cancel()
+
+    async def sync_templates(self):
+        # 扫描模板文件夹和写入模板库在线程池中进行，事件循环只负责调度
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(TEMPLATE_SYNC_INTERVAL)
+            try:
+                await loop.run_in_executor(None, self.templates.sync)
+            except Exception as e:
+                print(f"警告: 无法导入模板文件夹 - {e}", file=sys.stderr)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader, writer)
+                except HTTPError as e:
+                    await self.send_json(writer, e.status, {"error": str(e)}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, target, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                try:
+                    status, content_type, payload, extra = await self.dispatch(method, target, headers, body)
+                except HTTPError as e:
+                    status, content_type, payload, extra = self.json_response(e.status, {"error": str(e)})
+                await self.send(writer, status, content_type, payload, extra, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader, writer):
+        # 返回 (方法, 路径, 请求头, 请求体)，连接关闭时返回None
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        try:
+            method, target, _ = line.decode("latin-1").split(None, 2)
+        except ValueError:
+            raise HTTPError(400, "无效的请求行")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = b""
+        if method == "POST":
+            if "content-length" not in headers:
+                raise HTTPError(411, "需要 Content-Length")
+            try:
+                length = int(headers["content-length"])
+            except ValueError:
+                raise HTTPError(400, "无效的 Content-Length")
+            if length > MAX_BODY_SIZE:
+                raise HTTPError(413, "图片过大")
+            # curl 等客户端发送较大的请求体前会等待 100 Continue，不回复时要等待约1秒才发送
+            if headers.get("expect", "").lower() == "100-continue":
+                writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                await writer.drain()
+            body = await reader.readexactly(length)
+        return method, target, headers, body
+
+    async def dispatch(self, method, target, headers, body):
+        url = urlsplit(target)
+        query = dict(parse_qsl(url.query))
+        if url.path == "/watermark":
+            if method != "POST":
+                raise HTTPError(405, "请使用 POST")
+            return await self.watermark(query, headers, body)
+        if url.path == "/templates" and method == "GET":
+            return self.json_response(200, {"templates": self.templates.names()})
+        if url.path == "/stats" and method == "GET":
+            return self.json_response(200, self.stats())
+        raise HTTPError(404, "未知的路径")
+
+    def resolve_source(self, query, headers, body):
+        # 返回 (图片数据或文件路径, 请求参数)
+        if headers.get("content-type", "").split(";")[0].strip() != "application/json":
+            if not body:
+                raise HTTPError(400, "请求体为空")
+            return body, query
+        try:
+            params = dict(query, **json.loads(body.decode("utf-8")))
+        except (ValueError, TypeError):
+            raise HTTPError(400, "无效的JSON")
+        path = params.get("path")
+        if not isinstance(path, str) or not path:
+            raise HTTPError(400, "缺少 path")
+        # 只允许读取启动服务时指定的文件夹中的文件
+        real_path = os.path.realpath(path)
+        if not any(os.path.commonpath([real_path, root]) == root for root in self.allowed_paths):
+            raise HTTPError(403, "不允许读取该路径")
+        return real_path, params
+
+    async def watermark(self, query, headers, body):
+        source, params = self.resolve_source(query, headers, body)
+        template = params.get("template") or ""
+        try:
+            settings = self.templates.get(template)
+        except KeyError:
+            raise HTTPError(404, f"找不到模板: {template}")
+        output_format = (params.get("format") or settings["output_format"]).upper()
+        if output_format not in watermark_core.OUTPUT_FORMATS:
+            raise HTTPError(400, f"不支持的输出格式: {output_format}")
+        if output_format != settings["output_format"]:
+            settings = dict(settings, output_format=output_format)
+
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPError(503, "服务繁忙，请稍后重试")
+        self.pending += 1
+        self.requests += 1
+        start = time.perf_counter()
+        try:
+            data, error, internal = await self._batcher.render((template, output_format), source, settings)
+        finally:
+            self.pending -= 1
+        seconds = time.perf_counter() - start
+        self._latencies.append(seconds)
+        if error is not None:
+            if internal:
+                self.internal_errors += 1
+                raise HTTPError(500, error)
+            self.failed += 1
+            raise HTTPError(400, error)
+        return 200, CONTENT_TYPES.get(output_format, "application/octet-stream"), data, {
+            "X-Render-Time": f"{seconds * 1000:.1f}"
+        }
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(round(fraction * (len(latencies) - 1))))] * 1000, 1)
+
+        batcher = self._batcher
+        return {
+            "workers": self.max_workers,
+            "requests": self.requests,
+            "pending": self.pending,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "internal_errors": self.internal_errors,
+            "batches": batcher.batches if batcher else 0,
+            "mean_batch_size": round(batcher.batched_items / batcher.batches, 2) if batcher and batcher.batches else None,
+            "p50_ms": percentile(0.50),
+            "p90_ms": percentile(0.90),
+            "p99_ms": percentile(0.99)
+        }
+
+    def json_response(self, status, data):
+        return status, "application/json; charset=utf-8", json.dumps(data, ensure_ascii=False).encode("utf-8"), {}
+
+    async def send_json(self, writer, status, data, keep_alive=True):
+        _, content_type, payload, extra = self.json_response(status, data)
+        await self.send(writer, status, content_type, payload, extra, keep_alive)
+
+    async def send(self, writer, status, content_type, payload, extra=None, keep_alive=True):
+        lines = [
+            f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {len(payload)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}"
+        ]
+        if status == 503:
+            lines.append("Retry-After: 1")
+        lines.extend(f"{name}: {value}" for name, value in (extra or {}).items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        writer.write(payload)
+        await writer.drain()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="本地HTTP水印服务，供其他程序调用")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="监听地址，默认只接受本机连接")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="监听端口")
+    parser.add_argument("--templates", default=os.path.join(os.getcwd(), "templates"), help="模板文件夹")
+    parser.add_argument("-s", "--settings", help="没有指定模板时使用的设置文件（如 watermark_settings.json）")
+    parser.add_argument("-j", "--workers", type=int, default=default_worker_count(), help="渲染进程数")
+    parser.add_argument("--max-pending", type=int, default=DEFAULT_MAX_PENDING, help="同时排队和处理的请求数上限")
+    parser.add_argument("--batch-window", type=float, default=DEFAULT_BATCH_WINDOW * 1000, help="合并请求的等待时间（毫秒）")
+    parser.add_argument("--max-batch", type=int, default=DEFAULT_MAX_BATCH, help="每批最多合并的图片数")
+    parser.add_argument("--allow-path", action="append", default=[], help="允许按文件路径读取图片的文件夹，可指定多个")
+    parser.add_argument("--max-megapixels", type=int, help="允许处理的最大像素数（百万）")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        base_settings = watermark_core.load_settings_file(args.settings) if args.settings else None
+    except (OSError, ValueError) as e:
+        print(f"错误: 无法读取设置 - {e}", file=sys.stderr)
+        return 2
+    max_image_pixels = args.max_megapixels * 1000000 if args.max_megapixels else None
+    configure_image_limits(max_image_pixels)
+
+    server = WatermarkServer(
+        args.templates, args.workers, args.max_pending, args.batch_window / 1000, args.max_batch,
+        args.allow_path, max_image_pixels, base_settings
+    )
+
+    def on_ready(address):
+        print(f"水印服务已启动: http://{address[0]}:{address[1]}（{server.max_workers} 个渲染进程，按 Ctrl+C 退出）",
+              file=sys.stderr)
+
+    try:
+        asyncio.run(server.serve(args.host, args.port, on_ready))
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        print(f"错误: 无法启动服务 - {e}", file=sys.stderr)
+        return 1
+    finally:
+        server.shutdown()
+    print("服务已停止", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())